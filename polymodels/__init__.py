@@ -1,3 +1,23 @@
 VERSION = (1, 8, 1, "final", 0)
 
 __version__ = "1.8.1"
+
+
+def type_cast_many(objs, with_prefetched_objects=False, using=None):
+    """
+    Type cast polymorphic `objs` while preserving their order by issuing a
+    single query per content type.
+    """
+    # Avoid importing models before the app registry is ready.
+    from .managers import type_cast_many
+
+    return type_cast_many(objs, with_prefetched_objects, using)
+
+
+async def atype_cast_many(objs, with_prefetched_objects=False, using=None):
+    """
+    Asynchronous version of `type_cast_many`.
+    """
+    from .managers import atype_cast_many
+
+    return await atype_cast_many(objs, with_prefetched_objects, using)
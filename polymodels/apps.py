@@ -0,0 +1,79 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+
+from .snapshot import cache_content_types_snapshot, load_content_types_snapshot
+
+
+def preload_content_types(models, using):
+    """
+    Retrieve the content types of `models` from database `using` in a single
+    query and add them to the content types cache without creating missing
+    ones.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    keys = {(model._meta.app_label, model._meta.model_name) for model in models}
+    if not keys:
+        return
+    manager = ContentType.objects.db_manager(using)
+    content_types = manager.filter(
+        app_label__in={app_label for app_label, _model in keys},
+        model__in={model for _app_label, model in keys},
+    )
+    for content_type in content_types:
+        if (content_type.app_label, content_type.model) in keys:
+            manager._add_to_cache(using, content_type)
+
+
+class PolymodelsConfig(AppConfig):
+    name = "polymodels"
+
+    def ready(self):
+        from .models import BasePolymorphicModel
+
+        self.snapshot = {}
+        snapshot_path = getattr(settings, "POLYMODELS_CONTENT_TYPES_SNAPSHOT", None)
+        if snapshot_path:
+            index = BasePolymorphicModel.subclass_accessors.get_index()
+            self.load_snapshot(snapshot_path, index.accessors)
+        if not getattr(settings, "POLYMODELS_WARMUP", True):
+            return
+        self.warmed_up_aliases = set()
+        # Accessing the database while apps are getting ready is discouraged
+        # so content types are preloaded on first connection instead.
+        connection_created.connect(self.connection_created_receiver)
+
+    def load_snapshot(self, path, models):
+        """
+        Load the snapshot stored at `path` and add its entries to the content
+        types cache if it covers `models`. They are validated against their
+        database before the first content type is written to it.
+        """
+        snapshot = load_content_types_snapshot(path, models)
+        if snapshot:
+            self.snapshot = {
+                alias: entries
+                for alias, entries in snapshot.items()
+                if alias in connections.settings
+            }
+            cache_content_types_snapshot(self.snapshot)
+
+    def connection_created_receiver(self, connection, **kwargs):
+        from .models import BasePolymorphicModel
+
+        alias = connection.alias
+        # Connections such as the ones opened without a database to create
+        # test databases don't have a configured alias.
+        if alias in self.warmed_up_aliases or alias not in connections.settings:
+            return
+        # Content types of snapshotted aliases are already cached.
+        if alias not in self.snapshot:
+            models = BasePolymorphicModel.subclass_accessors.get_index().accessors
+            try:
+                preload_content_types(models, alias)
+            except DatabaseError:
+                # The content types table might not exist yet.
+                pass
+        self.warmed_up_aliases.add(alias)
@@ -0,0 +1,58 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.deletion import Collector
+
+
+class PolymorphicCollector(Collector):
+    """
+    Collector that relies on the content type of polymorphic objects to avoid
+    querying the tables of subclasses they cannot be an instance of.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Content type pks of the collected objects keyed by the model owning
+        # their content type field and their pk which is shared by the rows
+        # of every table of their hierarchy.
+        self.content_type_ids = {}
+
+    def get_content_type_models(self, objs):
+        """
+        Return the models of the content types of `objs` or `None` if they
+        cannot be determined without querying the database.
+        """
+        models = set()
+        content_type_ids = set()
+        for obj in objs:
+            content_type_field = getattr(obj, "CONTENT_TYPE_FIELD", None)
+            if content_type_field is None:
+                return None
+            key = (obj._meta.get_field(content_type_field).model, obj.pk)
+            try:
+                content_type_id = obj.__dict__["%s_id" % content_type_field]
+            except KeyError:
+                # Children rows are collected with a deferred content type
+                # which is known from their previously collected parent row.
+                content_type_id = self.content_type_ids.get(key)
+                if content_type_id is None:
+                    return None
+            else:
+                self.content_type_ids[key] = content_type_id
+            if content_type_id not in content_type_ids:
+                content_type_ids.add(content_type_id)
+                content_type = ContentType.objects.db_manager(self.using).get_for_id(
+                    content_type_id
+                )
+                model = content_type.model_class()
+                if model is None:
+                    return None
+                models.add(model)
+        return models
+
+    def related_objects(self, related_model, related_fields, objs):
+        if objs and all(field.remote_field.parent_link for field in related_fields):
+            models = self.get_content_type_models(objs)
+            if models is not None and not any(
+                issubclass(model, related_model) for model in models
+            ):
+                return related_model._base_manager.using(self.using).none()
+        return super().related_objects(related_model, related_fields, objs)
@@ -12,6 +12,7 @@ from django.utils.functional import LazyObject, empty
 from django.utils.translation import gettext_lazy as _
 
 from .models import BasePolymorphicModel
+from .snapshot import ensure_content_types_snapshot_validated
 from .utils import get_content_type
 
 
@@ -72,6 +73,7 @@ class ContentTypeReference:
 
     def __call__(self):
         model = apps.get_model(self.app_label, self.model_name)
+        ensure_content_types_snapshot_validated()
         return get_content_type(model).pk
 
     def __repr__(self):
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ...models import BasePolymorphicModel
+from ...snapshot import dump_content_types_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write a snapshot of the content types of polymorphic models to be "
+        "loaded on startup."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            nargs="?",
+            help="Path of the snapshot, defaults to the "
+            "POLYMODELS_CONTENT_TYPES_SNAPSHOT setting.",
+        )
+        parser.add_argument(
+            "--database",
+            action="append",
+            dest="databases",
+            help="Database to snapshot the content types of, can be specified "
+            'multiple times. Defaults to the "default" database.',
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"] or getattr(
+            settings, "POLYMODELS_CONTENT_TYPES_SNAPSHOT", None
+        )
+        if not path:
+            raise CommandError(
+                "A path must be provided when the "
+                "POLYMODELS_CONTENT_TYPES_SNAPSHOT setting is not defined."
+            )
+        models = BasePolymorphicModel.subclass_accessors.get_index().accessors
+        databases = options["databases"] or [DEFAULT_DB_ALIAS]
+        with open(path, "w") as fp:
+            dump_content_types_snapshot(models, databases, fp)
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "Wrote the content types of %d polymorphic models to %s."
+                % (len(models), path)
+            )
@@ -1,62 +1,1082 @@
+from collections import defaultdict
 from functools import partial
+from itertools import islice
 from operator import methodcaller
 
-from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist, FieldError, ImproperlyConfigured
+from django.db import connections, models, transaction
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import F, OrderBy, Value
+from django.db.models.functions import Cast
 from django.db.models.query import ModelIterable
 
+from .deletion import PolymorphicCollector
+from .snapshot import ensure_content_types_snapshot_validated
+from .utils import (
+    copy_fields,
+    copy_prefetched_objects,
+    get_content_type,
+    get_content_types,
+)
+
 type_cast_iterator = partial(map, methodcaller("type_cast"))
 type_cast_prefetch_iterator = partial(
     map, methodcaller("type_cast", with_prefetched_objects=True)
 )
 
 
+def get_inheritance_chain(model):
+    """
+    Return the concrete models `model` inherits from ordered from the root of
+    its hierarchy to its own concrete model or `None` when it is made of
+    multiple parents.
+    """
+    chain = [model._meta.concrete_model]
+    while True:
+        parents = chain[0]._meta.parents
+        if not parents:
+            return chain
+        if len(parents) > 1:
+            return None
+        chain.insert(0, next(iter(parents)))
+
+
+def get_batches(iterable, batch_size):
+    """
+    Yield lists of at most `batch_size` items of `iterable`.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_related_lookups(accessors, models):
+    """
+    Return the `select_related` lookups required to type cast to `models`.
+    """
+    related_lookups = set()
+    for model in models:
+        # Avoid collecting ourself and proxy subclasses
+        related_lookup = accessors[model].related_lookup
+        if related_lookup:
+            related_lookups.add(related_lookup)
+    return related_lookups
+
+
+def bulk_type_cast(
+    content_type_id, accessor, objs, using, with_prefetched_objects=False, lean=False
+):
+    """
+    Type cast `objs` sharing the same content type by retrieving the ones that
+    cannot be casted without querying the database through a single `pk__in`
+    query.
+    """
+    # Proxies of the objects model, the model itself, and objects for which
+    # the subclass chain was already retrieved (e.g. through select_related or
+    # prefetch_related) don't require any extra query to be casted.
+    pks = [obj.pk for obj in objs if not accessor.is_cached(obj)]
+    subclass_objs = {}
+    if pks:
+        model = (
+            ContentType.objects.db_manager(using)
+            .get_for_id(content_type_id)
+            .model_class()
+        )
+        subclass_objs = model._base_manager.using(using).order_by().in_bulk(pks)
+    casted = []
+    casted_pks = set()
+    for obj in objs:
+        pk = obj.pk
+        subclass_obj = subclass_objs.get(pk)
+        if subclass_obj is None:
+            subclass_obj = accessor(obj, with_prefetched_objects, lean)
+        else:
+            # Rows sharing the same pk (e.g. when filtering against multi-valued
+            # relationships) must not share the same instance.
+            if pk in casted_pks:
+                subclass_obj = copy_fields(subclass_obj, type(subclass_obj))
+            else:
+                casted_pks.add(pk)
+            if with_prefetched_objects:
+                copy_prefetched_objects(obj, subclass_obj)
+        casted.append(subclass_obj)
+    return casted
+
+
+def type_cast_many(objs, with_prefetched_objects=False, using=None):
+    """
+    Type cast polymorphic `objs` while preserving their order by issuing a
+    single query per content type. Objects are retrieved from the database
+    they were loaded from unless `using` is specified.
+    """
+    objs = list(objs)
+    groups = defaultdict(list)
+    for index, obj in enumerate(objs):
+        content_type_id = getattr(obj, "%s_id" % obj.CONTENT_TYPE_FIELD)
+        key = (type(obj), using or obj._state.db, content_type_id)
+        groups[key].append(index)
+    for (model, db, content_type_id), indexes in groups.items():
+        casted = bulk_type_cast(
+            content_type_id,
+            model.subclass_accessors.get_dispatch()[content_type_id],
+            [objs[index] for index in indexes],
+            db,
+            with_prefetched_objects,
+        )
+        for index, obj in zip(indexes, casted):
+            objs[index] = obj
+    return objs
+
+
+async def atype_cast_many(objs, with_prefetched_objects=False, using=None):
+    """
+    Asynchronous version of `type_cast_many`.
+    """
+    return await sync_to_async(type_cast_many)(objs, with_prefetched_objects, using)
+
+
 class PolymorphicModelIterable(ModelIterable):
+    # Whether or not select_subclasses() should join the subclasses tables.
+    joins_subclasses = True
+
     def __init__(self, queryset, type_cast=True, **kwargs):
         self.type_cast = type_cast
+        self.lean = getattr(queryset, "_lean_cast", False)
         super().__init__(queryset, **kwargs)
 
     def __iter__(self):
+        if self.type_cast:
+            self.load_content_type()
         iterator = super().__iter__()
         if self.type_cast:
-            iterator = type_cast_iterator(iterator)
+            iterator = self.chunked_cast(iterator)
         return iterator
 
+    def load_content_type(self):
+        """
+        Make sure the content type column is loaded as objects are type casted
+        based on it and refreshing it would require a query per object.
+        """
+        queryset = self.queryset
+        query = queryset.query
+        field = queryset.model._meta.get_field(queryset.model.CONTENT_TYPE_FIELD)
+        field_names, defer = query.deferred_loading
+        names = {field.name, field.attname}
+        if defer:
+            if not field_names & names:
+                return
+            field_names = field_names - names
+        else:
+            if field_names & names:
+                return
+            field_names = field_names | {field.name}
+        self.queryset = queryset._chain()
+        self.queryset.query.deferred_loading = (frozenset(field_names), defer)
+
+    @property
+    def cast_chunk_size(self):
+        return self.chunk_size
+
+    def chunked_cast(self, iterator):
+        while True:
+            chunk = list(islice(iterator, self.cast_chunk_size))
+            if not chunk:
+                return
+            yield from self.cast(chunk)
+
+    def cast(self, objs, with_prefetched_objects=False):
+        """
+        Type cast `objs` by groups of objects sharing the same content type
+        while preserving their order. Lists are casted in place in lean mode.
+        """
+        if not (self.lean and isinstance(objs, list)):
+            objs = list(objs)
+        model = self.queryset.model
+        dispatch = model.subclass_accessors.get_dispatch()
+        content_type_field_attname = "%s_id" % model.CONTENT_TYPE_FIELD
+        query = self.queryset.query
+        # Extra selects and annotations are only assigned to base instances.
+        attrs = [*query.extra_select, *query.annotation_select]
+        groups = defaultdict(list)
+        for index, obj in enumerate(objs):
+            groups[getattr(obj, content_type_field_attname)].append(index)
+        for content_type_id, indexes in groups.items():
+            casted = self.cast_group(
+                content_type_id,
+                dispatch[content_type_id],
+                [objs[index] for index in indexes],
+                with_prefetched_objects,
+            )
+            for index, obj in zip(indexes, casted):
+                if attrs and obj is not objs[index]:
+                    base_attrs = objs[index].__dict__
+                    for attr in attrs:
+                        if attr in base_attrs:
+                            obj.__dict__[attr] = base_attrs[attr]
+                objs[index] = obj
+        return objs
+
+    def cast_group(self, content_type_id, accessor, objs, with_prefetched_objects):
+        lean = self.lean
+        return [accessor(obj, with_prefetched_objects, lean) for obj in objs]
+
+
+class AdaptivePolymorphicModelIterable(PolymorphicModelIterable):
+    """
+    Iterable that only joins the subclasses tables required to type cast the
+    content types actually present in the queryset as determined by a prior
+    DISTINCT query.
+    """
+
+    joins_subclasses = False
+
+    def __iter__(self):
+        related_lookups = self.get_related_lookups()
+        if related_lookups:
+            self.queryset = self.queryset._chain()
+            self.queryset.query.add_select_related(related_lookups)
+        return super().__iter__()
+
+    def get_related_lookups(self):
+        queryset = self.queryset
+        query = queryset.query
+        accessors = queryset.model.subclass_accessors
+        # Distinct content types cannot be retrieved without altering the
+        # semantic of sliced, combined, and distinct on fields querysets.
+        if query.is_sliced or query.combinator or query.distinct_fields:
+            return get_related_lookups(
+                accessors, queryset._selected_subclasses or accessors
+            )
+        content_type_ids = queryset._content_type_ids
+        if content_type_ids is None:
+            content_type_ids = queryset._content_type_ids = set(
+                queryset.order_by()
+                .values_list("%s_id" % queryset.model.CONTENT_TYPE_FIELD, flat=True)
+                .distinct()
+            )
+        models = []
+        for content_type_id in content_type_ids:
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is not None:
+                models.append(model)
+        return get_related_lookups(accessors, models)
+
+
+class PerTypePolymorphicModelIterable(PolymorphicModelIterable):
+    """
+    Iterable that fetches base rows first and then retrieves the rows of each
+    concrete subclass through a single `pk__in` query per content type.
+    """
+
+    joins_subclasses = False
+
+    @property
+    def cast_chunk_size(self):
+        # Avoid issuing queries for each chunk when all the results are
+        # retrieved at once anyway.
+        return self.chunk_size if self.chunked_fetch else None
+
+    def cast_group(self, content_type_id, accessor, objs, with_prefetched_objects):
+        return bulk_type_cast(
+            content_type_id,
+            accessor,
+            objs,
+            self.queryset.db,
+            with_prefetched_objects,
+            self.lean,
+        )
+
+
+class UnionPolymorphicModelIterable(PerTypePolymorphicModelIterable):
+    """
+    Iterable that retrieves objects through a single UNION ALL query made of
+    one branch per concrete subclass that only joins its own parents chain and
+    pads the columns it lacks with NULLs.
+
+    Querysets relying on features that cannot be expressed on each branch are
+    type casted using the per type strategy instead.
+    """
+
+    column_alias = "_polymodels_col%d"
+
+    def __iter__(self):
+        if not self.type_cast:
+            return super().__iter__()
+        ordering = self.get_ordering()
+        if ordering is None:
+            return super().__iter__()
+        return self.union_iterator(ordering)
+
+    def get_ordering(self):
+        """
+        Return the ordering of the queryset as a list of `OrderBy` or None if
+        it cannot be expressed on each branch of the union.
+        """
+        queryset = self.queryset
+        query = queryset.query
+        if (
+            query.combinator
+            or query.distinct_fields
+            or query.select_for_update
+            or query.select_related
+            or query.extra
+            or query.extra_order_by
+            or query.group_by is not None
+            or query.deferred_loading != (frozenset(), True)
+            or queryset._known_related_objects
+            or any(
+                getattr(annotation, "contains_aggregate", False)
+                for annotation in query.annotations.values()
+            )
+        ):
+            return None
+        if query.order_by:
+            terms = query.order_by
+        elif query.default_ordering:
+            terms = query.get_meta().ordering
+        else:
+            terms = ()
+        ordering = []
+        for term in terms:
+            if hasattr(term, "resolve_expression"):
+                ordering.append(term if isinstance(term, OrderBy) else term.asc())
+                continue
+            if term == "?":
+                return None
+            name = term.lstrip("-")
+            if name not in query.annotations:
+                # Ordering by a relation implicitly involves the related
+                # model's ordering which cannot be referenced as a column.
+                try:
+                    _, final_field, _, rest = query.names_to_path(
+                        name.split(LOOKUP_SEP), query.get_meta()
+                    )
+                except FieldError:
+                    return None
+                if rest or final_field.is_relation:
+                    return None
+            ordering.append(F(name).desc() if term.startswith("-") else F(name).asc())
+        return ordering
+
+    def union_iterator(self, ordering):
+        queryset = self.queryset
+        query = queryset.query
+        db = queryset.db
+        model = queryset.model
+        accessors = model.subclass_accessors
+        subclasses = queryset._selected_subclasses or tuple(accessors)
+        concrete_model = model._meta.concrete_model
+        # Models sharing the same concrete model are retrieved by the same
+        # branch of the union.
+        branches = defaultdict(list)
+        for subclass in subclasses:
+            branches[subclass._meta.concrete_model].append(subclass)
+        lookup_models = {
+            accessor.related_lookup: subclass
+            for subclass, accessor in accessors.items()
+            if accessor.related_lookup and not accessor.proxy
+        }
+        field_lookups = {
+            field: field.attname for field in concrete_model._meta.concrete_fields
+        }
+        base_fields = set(field_lookups)
+        branches_fields = {}
+        for branch_model in branches:
+            branch_fields = set(base_fields)
+            attrs = (
+                () if branch_model is concrete_model else accessors[branch_model].attrs
+            )
+            for depth in range(1, len(attrs) + 1):
+                lookup = LOOKUP_SEP.join(attrs[:depth])
+                for field in lookup_models[lookup]._meta.local_concrete_fields:
+                    field_lookups.setdefault(
+                        field, LOOKUP_SEP.join((lookup, field.attname))
+                    )
+                    branch_fields.add(field)
+            branches_fields[branch_model] = branch_fields
+        fields = list(field_lookups)
+        columns = {field: index for index, field in enumerate(fields)}
+        annotation_columns = {
+            name: index
+            for index, name in enumerate(query.annotation_select, len(fields))
+        }
+        aliases = [
+            self.column_alias % index
+            for index in range(len(fields) + len(annotation_columns) + len(ordering))
+        ]
+        template = queryset._chain()
+        template.query.clear_limits()
+        template.query.clear_ordering(force=True)
+        unions = []
+        for branch_model, branch_fields in branches_fields.items():
+            expressions = [
+                (
+                    F(field_lookups[field])
+                    if field in branch_fields
+                    # Typed NULLs ensure all branches of the union have
+                    # matching column types on every backend.
+                    else Cast(Value(None), output_field=field)
+                )
+                for field in fields
+            ]
+            expressions.extend(F(name) for name in annotation_columns)
+            expressions.extend(order_by.expression for order_by in ordering)
+            unions.append(
+                template.filter(**model.content_type_lookup(*branches[branch_model]))
+                .annotate(**dict(zip(aliases, expressions)))
+                .values(*aliases)
+            )
+        combined = (
+            unions[0].union(*unions[1:], all=True) if len(unions) > 1 else unions[0]
+        )
+        ordering_aliases = islice(aliases, len(fields) + len(annotation_columns), None)
+        combined = combined.order_by(
+            *(
+                OrderBy(
+                    F(alias),
+                    descending=order_by.descending,
+                    nulls_first=order_by.nulls_first,
+                    nulls_last=order_by.nulls_last,
+                )
+                for alias, order_by in zip(ordering_aliases, ordering)
+            )
+        )
+        combined.query.set_limits(query.low_mark, query.high_mark)
+        # Map each content type to the model to instantiate and the columns
+        # holding its concrete fields values.
+        content_types = get_content_types(*subclasses)
+        builders = {}
+        for branch_model, branch_models in branches.items():
+            concrete_fields = branch_model._meta.concrete_fields
+            attnames = [field.attname for field in concrete_fields]
+            indexes = [columns[field] for field in concrete_fields]
+            for subclass in branch_models:
+                builders[content_types[subclass].pk] = (subclass, attnames, indexes)
+        content_type_index = columns[
+            concrete_model._meta.get_field(model.CONTENT_TYPE_FIELD)
+        ]
+        compiler = combined.query.get_compiler(using=db)
+        for row in compiler.results_iter(
+            chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size
+        ):
+            subclass, attnames, indexes = builders[row[content_type_index]]
+            obj = subclass.from_db(db, attnames, [row[index] for index in indexes])
+            for name, index in annotation_columns.items():
+                setattr(obj, name, row[index])
+            yield obj
+
+
+class LeafPolymorphicModelIterable(PolymorphicModelIterable):
+    """
+    Iterable that directly instantiates the model of each row's content type
+    from the columns of the joined subclasses tables instead of instantiating
+    an object per table of the hierarchy.
+
+    Querysets retrieving related objects other than subclasses or deferring
+    fields are type casted using the join strategy instead.
+    """
+
+    def __iter__(self):
+        if not self.type_cast or not self.can_instantiate_leaves():
+            return super().__iter__()
+        return self.leaf_iterator()
+
+    def can_instantiate_leaves(self):
+        queryset = self.queryset
+        query = queryset.query
+        if (
+            query.extra_select
+            or query.deferred_loading != (frozenset(), True)
+            or queryset._known_related_objects
+            or query.select_related is True
+        ):
+            return False
+        # Only parent links of subclasses must be followed.
+        related = [(queryset.model, query.select_related or {})]
+        while related:
+            model, select_related = related.pop()
+            for name, nested in select_related.items():
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    return False
+                if not (field.one_to_one and getattr(field, "parent_link", False)):
+                    return False
+                related.append((field.related_model, nested))
+        return True
+
+    def leaf_iterator(self):
+        queryset = self.queryset
+        db = queryset.db
+        model = queryset.model
+        compiler = queryset.query.get_compiler(using=db)
+        results = compiler.execute_sql(
+            chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size
+        )
+        select = compiler.select
+        field_indexes = {}
+        klass_infos = [compiler.klass_info]
+        while klass_infos:
+            klass_info = klass_infos.pop()
+            for index in klass_info["select_fields"]:
+                field_indexes[select[index][0].target] = index
+            klass_infos.extend(klass_info.get("related_klass_infos", ()))
+        annotation_col_map = compiler.annotation_col_map
+        content_type_index = field_indexes[
+            model._meta.get_field(model.CONTENT_TYPE_FIELD)
+        ]
+        dispatch = model.subclass_accessors.get_dispatch()
+        leaves = {}
+        for row in compiler.results_iter(results):
+            content_type_id = row[content_type_index]
+            try:
+                leaf_model, attnames, indexes, accessor = leaves[content_type_id]
+            except KeyError:
+                leaf_model, attnames, indexes, accessor = leaves[content_type_id] = (
+                    self.get_leaf(content_type_id, dispatch, field_indexes)
+                )
+            obj = leaf_model.from_db(db, attnames, [row[index] for index in indexes])
+            if annotation_col_map:
+                for attr_name, col_pos in annotation_col_map.items():
+                    setattr(obj, attr_name, row[col_pos])
+            if accessor is not None:
+                obj = accessor(obj)
+            yield obj
+
+    def get_leaf(self, content_type_id, dispatch, field_indexes):
+        """
+        Return the model to instantiate rows of `content_type_id` with, the
+        attnames and the row indexes of its fields, and the accessor required
+        to type cast it if its tables were not joined.
+        """
+        leaf_model = (
+            ContentType.objects.db_manager(self.queryset.db)
+            .get_for_id(content_type_id)
+            .model_class()
+        )
+        accessor = None
+        if leaf_model is None or any(
+            field not in field_indexes for field in leaf_model._meta.concrete_fields
+        ):
+            leaf_model = self.queryset.model
+            accessor = dispatch[content_type_id]
+        fields = leaf_model._meta.concrete_fields
+        return (
+            leaf_model,
+            [field.attname for field in fields],
+            [field_indexes[field] for field in fields],
+            accessor,
+        )
+
 
 class PolymorphicQuerySet(models.query.QuerySet):
-    def select_subclasses(self, *models):
-        if issubclass(self._iterable_class, ModelIterable):
-            self._iterable_class = PolymorphicModelIterable
-        related_lookups = set()
-        accessors = self.model.subclass_accessors
-        if models:
-            subclasses = set()
-            for model in models:
-                if not issubclass(model, self.model):
-                    raise TypeError("%r is not a subclass of %r" % (model, self.model))
-                subclasses.update(model.subclass_accessors)
-            # Collect all `select_related` required lookups
-            for subclass in subclasses:
-                # Avoid collecting ourself and proxy subclasses
-                related_lookup = accessors[subclass].related_lookup
-                if related_lookup:
-                    related_lookups.add(related_lookup)
-            queryset = self.filter(**self.model.content_type_lookup(*tuple(subclasses)))
+    select_subclasses_iterable_classes = {
+        "join": PolymorphicModelIterable,
+        "adaptive": AdaptivePolymorphicModelIterable,
+        "per_type": PerTypePolymorphicModelIterable,
+        "union": UnionPolymorphicModelIterable,
+        "leaf": LeafPolymorphicModelIterable,
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._selected_subclasses = None
+        # Content types present in the results of this particular queryset,
+        # see AdaptivePolymorphicModelIterable.
+        self._content_type_ids = None
+        self._subclass_prefetch_related_lookups = ()
+        self._subclass_prefetch_done = False
+        self._lean_cast = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._selected_subclasses = self._selected_subclasses
+        clone._lean_cast = self._lean_cast
+        clone._subclass_prefetch_related_lookups = (
+            self._subclass_prefetch_related_lookups
+        )
+        return clone
+
+    def select_subclasses(
+        self, *models, strategy="join", lean=False, max_join_depth=None
+    ):
+        try:
+            iterable_class = self.select_subclasses_iterable_classes[strategy]
+        except KeyError:
+            raise ValueError(
+                "%r is not a valid select_subclasses strategy, choices are %s."
+                % (
+                    strategy,
+                    ", ".join(map(repr, self.select_subclasses_iterable_classes)),
+                )
+            )
+        if max_join_depth is not None:
+            if strategy != "join":
+                raise ValueError(
+                    "max_join_depth can only be used with the 'join' strategy."
+                )
+            if max_join_depth < 0:
+                raise ValueError("max_join_depth must be a non-negative integer.")
+            # Rows of types deeper than the joined tables are retrieved through
+            # a single query per type.
+            iterable_class = PerTypePolymorphicModelIterable
+        plan = self.model.subclass_accessors.get_select_subclasses_plan(models)
+        if plan.content_type_filter is not None:
+            queryset = self.filter(**plan.content_type_filter)
+            queryset._selected_subclasses = plan.subclasses
         else:
-            # Collect all `select_related` required relateds
-            for accessor in accessors.values():
-                # Avoid collecting ourself and proxy subclasses
-                related_lookup = accessor.related_lookup
-                if related_lookup:
-                    related_lookups.add(related_lookup)
-            queryset = self
-        if related_lookups:
-            queryset = queryset.select_related(*related_lookups)
+            queryset = self._chain()
+        if issubclass(queryset._iterable_class, ModelIterable):
+            queryset._iterable_class = iterable_class
+        queryset._lean_cast = lean
+        if max_join_depth is not None:
+            related_lookups = {
+                LOOKUP_SEP.join(related_lookup.split(LOOKUP_SEP)[:max_join_depth])
+                for related_lookup in plan.related_lookups
+            }
+            related_lookups.discard("")
+            if related_lookups:
+                queryset = queryset.select_related(*sorted(related_lookups))
+        # Other strategies either retrieve subclasses through separate queries
+        # or determine which tables to join on evaluation.
+        elif iterable_class.joins_subclasses and plan.related_lookups:
+            if (
+                isinstance(queryset.query.select_related, dict)
+                or queryset._fields is not None
+            ):
+                queryset = queryset.select_related(*plan.related_lookups)
+            else:
+                # The plan's structure is never altered in place as queries
+                # deep copy it when cloned.
+                queryset.query.select_related = plan.select_related
         return queryset
 
+    def prefetch_subclass_related(self, model, *lookups):
+        """
+        Prefetch the specified lookups on the type casted instances of `model`
+        once the results are retrieved. Passing `None` as `model` clears the
+        previously specified lookups.
+        """
+        clone = self._chain()
+        if model is None:
+            clone._subclass_prefetch_related_lookups = ()
+            return clone
+        if not issubclass(model, self.model):
+            raise TypeError("%r is not a subclass of %r" % (model, self.model))
+        clone._subclass_prefetch_related_lookups += ((model, lookups),)
+        return clone
+
     def exclude_subclasses(self):
         return self.filter(**self.model.content_type_lookup())
 
+    def bulk_create(
+        self,
+        objs,
+        batch_size=None,
+        ignore_conflicts=False,
+        update_conflicts=False,
+        update_fields=None,
+        unique_fields=None,
+    ):
+        """
+        Insert a mixed list of subclasses instances by inserting all the rows
+        of each table of their hierarchy at once, from the root table to the
+        leaf ones.
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError("Batch size must be a positive integer.")
+        objs = list(objs)
+        if not objs:
+            return objs
+        model = self.model
+        chains = {}
+        for obj in objs:
+            obj_model = type(obj)
+            if obj_model not in chains:
+                if not issubclass(obj_model, model):
+                    raise TypeError("%r is not a subclass of %r" % (obj_model, model))
+                chains[obj_model] = get_inheritance_chain(obj_model)
+        ensure_content_types_snapshot_validated()
+        content_types = get_content_types(*chains)
+        content_type_field_attname = "%s_id" % model.CONTENT_TYPE_FIELD
+        for obj in objs:
+            if getattr(obj, content_type_field_attname) is None:
+                setattr(obj, model.CONTENT_TYPE_FIELD, content_types[type(obj)])
+        if all(chain is not None and len(chain) == 1 for chain in chains.values()):
+            return super().bulk_create(
+                objs,
+                batch_size=batch_size,
+                ignore_conflicts=ignore_conflicts,
+                update_conflicts=update_conflicts,
+                update_fields=update_fields,
+                unique_fields=unique_fields,
+            )
+        if ignore_conflicts or update_conflicts:
+            raise ValueError(
+                "Conflicts handling is not supported when bulk creating "
+                "multi-table inherited instances."
+            )
+        self._for_write = True
+        db = self.db
+        connection = connections[db]
+        with transaction.atomic(using=db, savepoint=False):
+            # Models with multiple parents cannot be inserted table by table.
+            if None in chains.values():
+                for obj in objs:
+                    obj.save(force_insert=True, using=db)
+                return objs
+            root_pk = next(iter(chains.values()))[0]._meta.pk
+            parent_links = {
+                obj_model: [
+                    (child._meta.parents[parent].attname, parent._meta.pk.attname)
+                    for parent, child in reversed(list(zip(chain, chain[1:])))
+                ]
+                for obj_model, chain in chains.items()
+            }
+            for obj in objs:
+                obj._prepare_related_fields_for_save(operation_name="bulk_create")
+                # Propagate primary key values set on children to their parents
+                # like Model._save_parents() does.
+                for link_attname, parent_pk_attname in parent_links[type(obj)]:
+                    if getattr(obj, parent_pk_attname) is None:
+                        setattr(obj, parent_pk_attname, getattr(obj, link_attname))
+                if getattr(obj, root_pk.attname) is None:
+                    setattr(obj, root_pk.attname, root_pk.get_pk_value_on_save(obj))
+            # Primary keys of inserted rows must be retrieved in order to insert
+            # children tables rows which requires either a backend that can
+            # return them on bulk insertion or a row by row insertion.
+            if not connection.features.can_return_rows_from_bulk_insert and any(
+                getattr(obj, root_pk.attname) is None for obj in objs
+            ):
+                for obj in objs:
+                    obj.save(force_insert=True, using=db)
+                return objs
+            tables = {}
+            for obj in objs:
+                for table in chains[type(obj)]:
+                    tables.setdefault(table, []).append(obj)
+            for table, table_objs in tables.items():
+                self._bulk_insert_table(table, table_objs, batch_size)
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = db
+        return objs
+
+    bulk_create.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Update `fields` of a mixed list of subclasses instances by issuing
+        batched updates against each table owning some of them. Instances are
+        only updated for the fields their model defines. Return the highest
+        number of rows matched by the updates of a single table.
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError("Batch size must be a positive integer.")
+        if not fields:
+            raise ValueError("Field names must be given to bulk_update().")
+        objs = tuple(objs)
+        if any(obj.pk is None for obj in objs):
+            raise ValueError("All bulk_update() objects must have a primary key set.")
+        model = self.model
+        field_names = list(dict.fromkeys(fields))
+        # Field names are validated against all the subclasses regardless of
+        # the provided instances.
+        for name in field_names:
+            for subclass in model.subclass_accessors:
+                try:
+                    subclass._meta.get_field(name)
+                except FieldDoesNotExist:
+                    continue
+                break
+            else:
+                # Raise the appropriate exception.
+                model._meta.get_field(name)
+        owners = {}
+        tables = {}
+        fallback_objs = []
+        for obj in objs:
+            obj_model = type(obj)
+            if obj_model not in owners:
+                if not issubclass(obj_model, model):
+                    raise TypeError("%r is not a subclass of %r" % (obj_model, model))
+                obj_owners = owners[obj_model] = {}
+                for name in field_names:
+                    try:
+                        field = obj_model._meta.get_field(name)
+                    except FieldDoesNotExist:
+                        continue
+                    owner = field.model._meta.concrete_model
+                    obj_owners.setdefault(owner, []).append(name)
+            # Parents primary key values cannot be assumed to be the same as
+            # the instance's one when inheriting from multiple parents.
+            if get_inheritance_chain(obj_model) is None:
+                fallback_objs.append(obj)
+                continue
+            for owner, names in owners[obj_model].items():
+                tables.setdefault((owner, tuple(names)), []).append(obj)
+        self._for_write = True
+        db = self.db
+        rows_matched = 0
+        with transaction.atomic(using=db, savepoint=False):
+            for (owner, names), table_objs in tables.items():
+                rows_matched = max(
+                    rows_matched,
+                    owner._base_manager.using(db).bulk_update(
+                        table_objs, names, batch_size=batch_size
+                    ),
+                )
+            for obj in fallback_objs:
+                update_fields = [
+                    name for names in owners[type(obj)].values() for name in names
+                ]
+                if update_fields:
+                    obj.save(update_fields=update_fields, using=db)
+        return max(rows_matched, len(fallback_objs))
+
+    bulk_update.alters_data = True
+
+    def delete(self, keep_parents=False):
+        """
+        Delete the records in the current QuerySet. When `keep_parents` is
+        specified the rows of the parents of the queryset's model are kept and
+        their content type is reset to the one of the direct parent.
+        """
+        self._not_support_combined_queries("delete")
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with delete().")
+        if self.query.distinct_fields:
+            raise TypeError("Cannot call delete() after .distinct(*fields).")
+        if self._fields is not None:
+            raise TypeError("Cannot call delete() after .values() or .values_list()")
+        concrete_model = self.model._meta.concrete_model
+        parent_ptr = next(iter(concrete_model._meta.parents.values()), None)
+        if not keep_parents or parent_ptr is None:
+            del_query = self._chain()
+            del_query._for_write = True
+            del_query.query.select_for_update = False
+            del_query.query.select_related = False
+            del_query.query.clear_ordering(force=True)
+            # The collector expects objects of the queryset's model.
+            del_query._iterable_class = ModelIterable
+            # The content type of collected objects is used to avoid querying
+            # the tables of subclasses they cannot be an instance of.
+            collector = PolymorphicCollector(using=del_query.db, origin=self)
+            collector.collect(del_query)
+            deletion = collector.delete()
+            self._result_cache = None
+            return deletion
+        self._for_write = True
+        db = self.db
+        content_type_field = concrete_model._meta.get_field(
+            self.model.CONTENT_TYPE_FIELD
+        )
+        parent_content_type = get_content_type(parent_ptr.remote_field.model)
+        # Retrieve the affected rows beforehand as they won't be matched by
+        # the queryset anymore once deleted.
+        pks = list(self.order_by().values_list("pk", flat=True))
+        batch_size = max(connections[db].ops.bulk_batch_size(["pk"], pks), 1)
+        with transaction.atomic(using=db, savepoint=False):
+            collector = PolymorphicCollector(using=db, origin=self)
+            for batch in get_batches(pks, batch_size):
+                collector.collect(
+                    concrete_model._base_manager.using(db).filter(pk__in=batch),
+                    keep_parents=True,
+                )
+            deletion = collector.delete()
+            parent_manager = content_type_field.model._base_manager.using(db)
+            for batch in get_batches(pks, batch_size):
+                parent_manager.filter(pk__in=batch).update(
+                    **{content_type_field.attname: parent_content_type.pk}
+                )
+        self._result_cache = None
+        return deletion
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def change_type(self, to, **values):
+        """
+        Change the type of all the rows matched by this queryset to `to` by
+        inserting the rows of the tables they are missing, deleting the rows
+        of the tables they don't need anymore, and updating their content type.
+        The rows inserted in missing tables are initialized with `values` or
+        their fields default. Since the rows of a table are inserted through a
+        single statement callable defaults are only evaluated once per table
+        and batch. Return the number of rows whose type changed.
+        """
+        model = self.model
+        chain = get_inheritance_chain(to)
+        model_chain = get_inheritance_chain(model)
+        if chain is None or model_chain is None:
+            raise ValueError(
+                "Cannot change the type of models inheriting from multiple parents."
+            )
+        root = model_chain[0]
+        if not issubclass(to, root):
+            raise TypeError("%r is not a subclass of %r" % (to, root))
+        # Values can only be provided for the fields of the tables rows might
+        # be missing.
+        field_names = set()
+        for table in chain:
+            if table in model_chain:
+                continue
+            for field in table._meta.local_concrete_fields:
+                if field.remote_field and field.remote_field.parent_link:
+                    continue
+                field_names.update((field.name, field.attname))
+                # The default would be shared by all the inserted rows.
+                if (
+                    field.unique
+                    and callable(field.default)
+                    and field.name not in values
+                    and field.attname not in values
+                ):
+                    raise ValueError(
+                        "A value must be provided for %s.%s as its callable "
+                        "default cannot be evaluated for each inserted row."
+                        % (table.__name__, field.name)
+                    )
+        unknown_field_names = set(values).difference(field_names)
+        if unknown_field_names:
+            raise FieldError(
+                "Cannot provide values for %s which are not fields of the "
+                "tables inserted when changing the type to %s."
+                % (", ".join(map(repr, sorted(unknown_field_names))), to.__name__)
+            )
+        ensure_content_types_snapshot_validated()
+        content_type_id = get_content_type(to).pk
+        self._for_write = True
+        db = self.db
+        connection = connections[db]
+        content_type_field = root._meta.get_field(model.CONTENT_TYPE_FIELD)
+        # Retrieve the affected rows beforehand as the tables involved in the
+        # queryset might be altered.
+        groups = defaultdict(list)
+        for pk, row_content_type_id in self.order_by().values_list(
+            "pk", content_type_field.attname
+        ):
+            if row_content_type_id != content_type_id:
+                groups[row_content_type_id].append(pk)
+        changed = sum(map(len, groups.values()))
+        with transaction.atomic(using=db, savepoint=False):
+            collector = PolymorphicCollector(using=db)
+            root_manager = root._base_manager.using(db).order_by()
+            for row_content_type_id, pks in groups.items():
+                row_model = ContentType.objects.get_for_id(
+                    row_content_type_id
+                ).model_class()
+                row_chain = row_model and get_inheritance_chain(row_model)
+                if not row_chain:
+                    raise ValueError(
+                        "Cannot change the type of rows of unknown or multiple "
+                        "parents content type %s." % row_content_type_id
+                    )
+                missing_tables = [table for table in chain if table not in row_chain]
+                obsolete_tables = [table for table in row_chain if table not in chain]
+                batch_size = max(connection.ops.bulk_batch_size(["pk"], pks), 1)
+                for batch in get_batches(pks, batch_size):
+                    for table in missing_tables:
+                        self._insert_select_table(
+                            table, root_manager.filter(pk__in=batch), values
+                        )
+                    # Deleting the topmost obsolete table rows cascades to its
+                    # children.
+                    if obsolete_tables:
+                        collector.collect(
+                            obsolete_tables[0]
+                            ._base_manager.using(db)
+                            .filter(pk__in=batch),
+                            keep_parents=True,
+                        )
+                    root_manager.filter(pk__in=batch).update(
+                        **{content_type_field.attname: content_type_id}
+                    )
+            collector.delete()
+        return changed
+
+    change_type.alters_data = True
+
+    def _insert_select_table(self, table, queryset, values):
+        """
+        Insert a row in `table` for each row of `queryset` through an
+        `INSERT INTO ... SELECT` statement.
+        """
+        opts = table._meta
+        parent_link = next(iter(opts.parents.values()))
+        columns = []
+        selects = {}
+        for field in opts.local_concrete_fields:
+            if field is parent_link:
+                value = F("pk")
+            elif field.name in values or field.attname in values:
+                value = values.get(field.name, values.get(field.attname))
+                value = Value(getattr(value, "pk", value), output_field=field)
+            elif getattr(field, "generated", False) or (
+                getattr(field, "db_default", models.NOT_PROVIDED)
+                is not models.NOT_PROVIDED
+            ):
+                continue
+            else:
+                value = Value(field.get_default(), output_field=field)
+            columns.append(field.column)
+            selects["_polymodels_col%d" % len(selects)] = value
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        sql, params = (
+            queryset.annotate(**selects)
+            .values(*selects)
+            .query.get_compiler(self.db)
+            .as_sql()
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO %s (%s) %s"
+                % (
+                    quote_name(opts.db_table),
+                    ", ".join(map(quote_name, columns)),
+                    sql,
+                ),
+                params,
+            )
+
+    def _bulk_insert_table(self, table, objs, batch_size):
+        opts = table._meta
+        manager = table._base_manager.using(self.db)
+        fields = [
+            field
+            for field in opts.local_concrete_fields
+            if not getattr(field, "generated", False)
+        ]
+        parent_link = next(iter(opts.parents.values()), None)
+        if parent_link is not None:
+            parent_opts = parent_link.remote_field.model._meta
+            for obj in objs:
+                setattr(obj, parent_link.attname, obj._get_pk_val(parent_opts))
+            manager._batched_insert(objs, fields, batch_size)
+            return
+        objs_with_pk, objs_without_pk = [], []
+        for obj in objs:
+            if getattr(obj, opts.pk.attname) is None:
+                objs_without_pk.append(obj)
+            else:
+                objs_with_pk.append(obj)
+        if objs_with_pk:
+            manager._batched_insert(objs_with_pk, fields, batch_size)
+        if objs_without_pk:
+            fields = [field for field in fields if field is not opts.auto_field]
+            returned_columns = manager._batched_insert(
+                objs_without_pk, fields, batch_size
+            )
+            for obj, results in zip(objs_without_pk, returned_columns):
+                for result, field in zip(results, opts.db_returning_fields):
+                    setattr(obj, field.attname, result)
+
     def _fetch_all(self):
         # Override _fetch_all in order to disable PolymorphicModelIterable's
         # type casting when prefetch_related is used because the latter might
@@ -69,14 +1089,126 @@ class PolymorphicQuerySet(models.query.QuerySet):
             iterable_class = self._iterable_class
             if issubclass(iterable_class, PolymorphicModelIterable):
                 type_cast = bool(prefetch_related_objects)
-                iterable_class = partial(iterable_class, type_cast=not type_cast)
-            self._result_cache = list(iterable_class(self))
+                iterable = iterable_class(self, type_cast=not type_cast)
+            else:
+                iterable = iterable_class(self)
+            self._result_cache = list(iterable)
         if prefetch_related_objects:
             self._prefetch_related_objects()
             if type_cast:
-                self._result_cache = list(
-                    type_cast_prefetch_iterator(self._result_cache)
+                self._result_cache = iterable.cast(
+                    self._result_cache, with_prefetched_objects=True
+                )
+        if self._subclass_prefetch_related_lookups and not self._subclass_prefetch_done:
+            self._prefetch_subclass_related_objects(self._result_cache)
+            self._subclass_prefetch_done = True
+
+    def _prefetch_subclass_related_objects(self, objs):
+        for model, lookups in self._subclass_prefetch_related_lookups:
+            instances = [obj for obj in objs if isinstance(obj, model)]
+            if instances:
+                models.prefetch_related_objects(instances, *lookups)
+
+    def _prefetch_and_cast(self, iterable, objs):
+        """
+        Prefetch the related objects of a chunk of objects retrieved without
+        type casting, type cast them, and prefetch their subclass specific
+        related objects.
+        """
+        prefetch_related_lookups = self._prefetch_related_lookups
+        if prefetch_related_lookups:
+            models.prefetch_related_objects(objs, *prefetch_related_lookups)
+        objs = iterable.cast(
+            objs, with_prefetched_objects=bool(prefetch_related_lookups)
+        )
+        self._prefetch_subclass_related_objects(objs)
+        return objs
+
+    def _chunked_prefetch_and_cast(self, iterable, chunk_size):
+        iterator = iter(iterable)
+        while True:
+            objs = list(islice(iterator, chunk_size))
+            if not objs:
+                return
+            yield self._prefetch_and_cast(iterable, objs)
+
+    def _iterator(self, use_chunked_fetch, chunk_size):
+        # Prefetching on a mixed set of objects must happen prior to type
+        # casting, see _fetch_all.
+        if (
+            not issubclass(self._iterable_class, PolymorphicModelIterable)
+            or (self._prefetch_related_lookups and chunk_size is None)
+            or not (
+                self._prefetch_related_lookups
+                or self._subclass_prefetch_related_lookups
+            )
+        ):
+            yield from super()._iterator(use_chunked_fetch, chunk_size)
+            return
+        chunk_size = chunk_size or 2000
+        iterable = self._iterable_class(
+            self,
+            type_cast=False,
+            chunked_fetch=use_chunked_fetch,
+            chunk_size=chunk_size,
+        )
+        for chunk in self._chunked_prefetch_and_cast(iterable, chunk_size):
+            yield from chunk
+
+    async def aiterator(self, chunk_size=2000):
+        if not issubclass(self._iterable_class, PolymorphicModelIterable):
+            async for obj in super().aiterator(chunk_size=chunk_size):
+                yield obj
+            return
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be strictly positive.")
+        use_chunked_fetch = not connections[self.db].settings_dict.get(
+            "DISABLE_SERVER_SIDE_CURSORS"
+        )
+        iterable = self._iterable_class(
+            self,
+            type_cast=False,
+            chunked_fetch=use_chunked_fetch,
+            chunk_size=chunk_size,
+        )
+        # Retrieve, prefetch, and type cast each chunk in a single trip to the
+        # synchronous thread.
+        chunks = self._chunked_prefetch_and_cast(iterable, chunk_size)
+        while True:
+            chunk = await sync_to_async(next)(chunks, None)
+            if chunk is None:
+                return
+            for obj in chunk:
+                yield obj
+
+
+class PolymorphicPrefetch(models.Prefetch):
+    """
+    Prefetch object that type casts the prefetched instances of a polymorphic
+    model using the specified `select_subclasses` strategy. When `queryset` is
+    not provided the default manager of the root model of the hierarchy of
+    `subclasses` is used.
+    """
+
+    def __init__(
+        self, lookup, queryset=None, to_attr=None, subclasses=(), strategy="per_type"
+    ):
+        if queryset is None:
+            if not subclasses:
+                raise ValueError(
+                    "A queryset or subclasses must be provided to "
+                    "PolymorphicPrefetch."
                 )
+            model = subclasses[0]
+            root_model = model._meta.get_field(model.CONTENT_TYPE_FIELD).model
+            queryset = root_model._default_manager.all()
+        if not isinstance(queryset, PolymorphicQuerySet):
+            raise ValueError(
+                "PolymorphicPrefetch querysets must be PolymorphicQuerySet "
+                "instances."
+            )
+        queryset = queryset.select_subclasses(*subclasses, strategy=strategy)
+        super().__init__(lookup, queryset, to_attr)
 
 
 class PolymorphicManager(models.Manager.from_queryset(PolymorphicQuerySet)):
@@ -91,10 +1223,25 @@ class PolymorphicManager(models.Manager.from_queryset(PolymorphicQuerySet)):
             )
         return super().contribute_to_class(model, name)
 
+    def type_cast_many(self, objs, with_prefetched_objects=False):
+        """
+        Type cast `objs` by issuing a single query per content type on the
+        database of this manager if it was explicitly specified.
+        """
+        return type_cast_many(objs, with_prefetched_objects, using=self._db)
+
+    async def atype_cast_many(self, objs, with_prefetched_objects=False):
+        """
+        Asynchronous version of `type_cast_many`.
+        """
+        return await atype_cast_many(objs, with_prefetched_objects, using=self._db)
+
     def get_queryset(self):
         queryset = super().get_queryset()
         model = self.model
         if model._meta.proxy:
             # Select only associated model and its subclasses.
-            queryset = queryset.filter(**self.model.subclasses_lookup())
+            queryset = queryset.filter(
+                **self.model.subclasses_lookup(using=queryset.db)
+            )
         return queryset
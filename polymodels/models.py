@@ -1,7 +1,9 @@
 import threading
 from collections import defaultdict, namedtuple
 from operator import attrgetter
+from types import MappingProxyType
 
+from asgiref.sync import sync_to_async
 from django.contrib.contenttypes.models import ContentType
 from django.core import checks
 from django.core.exceptions import FieldDoesNotExist
@@ -10,8 +12,15 @@ from django.db.models.constants import LOOKUP_SEP
 from django.db.models.signals import class_prepared
 from django.utils.functional import cached_property
 
-from .managers import PolymorphicManager
-from .utils import copy_fields, get_content_type, get_content_types
+from .managers import PolymorphicManager, get_related_lookups
+from .snapshot import ensure_content_types_snapshot_validated
+from .utils import (
+    copy_fields,
+    copy_prefetched_objects,
+    get_content_type,
+    get_content_types,
+    get_content_types_cache,
+)
 
 
 class SubclassAccessor(
@@ -27,47 +36,268 @@ class SubclassAccessor(
             return self._identity
         return attrgetter(".".join(self.attrs))
 
-    def __call__(self, obj, with_prefetched_objects=False):
+    def is_cached(self, obj):
+        """
+        Return whether or not `obj` can be casted without querying the
+        database.
+        """
+        for attr in self.attrs:
+            obj = obj._state.fields_cache.get(attr)
+            if obj is None:
+                return False
+        return True
+
+    def detach(self, obj):
+        """
+        Clear the related objects caches linking `obj` to its subclass
+        instance through the chain of parent links.
+        """
+        for attr in self.attrs:
+            child = obj._state.fields_cache.pop(attr)
+            child._state.fields_cache.pop(
+                obj._meta.get_field(attr).remote_field.name, None
+            )
+            obj = child
+
+    def __call__(self, obj, with_prefetched_objects=False, lean=False):
         # Cast to the right concrete model by going up in the
         # SingleRelatedObjectDescriptor chain
         casted = self.attrgetter(obj)
+        # Allow parent instances to be garbage collected.
+        if lean:
+            self.detach(obj)
         # If it's a proxy model we make sure to type cast it
         proxy = self.proxy
         if proxy:
             casted = copy_fields(casted, proxy)
         if with_prefetched_objects:
-            try:
-                casted._prefetched_objects_cache.update(obj._prefetched_objects_cache)
-            except AttributeError:
-                casted._prefetched_objects_cache = obj._prefetched_objects_cache
+            copy_prefetched_objects(obj, casted)
         return casted
 
 
 EMPTY_ACCESSOR = SubclassAccessor((), None, "")
 
 
+SelectSubclassesPlan = namedtuple(
+    "SelectSubclassesPlan",
+    ["subclasses", "content_type_filter", "related_lookups", "select_related"],
+)
+
+
+class ContentTypeDispatch(dict):
+    """
+    Mapping of content type pks to the accessor of the corresponding subclass
+    that is lazily filled on lookup.
+    """
+
+    def __init__(self, accessors, content_types_cache, fields_cache):
+        super().__init__()
+        self.accessors = accessors
+        self.content_types_cache = content_types_cache
+        self.fields_cache = fields_cache
+
+    def __missing__(self, content_type_id):
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        accessor = self[content_type_id] = self.accessors[model]
+        return accessor
+
+
+class ModelSubclassAccessors(dict):
+    """
+    Mapping of a model's subclasses to their accessor.
+    """
+
+    def __init__(self, model, accessors):
+        super().__init__(accessors)
+        self.model = model
+        self.dispatch = None
+        # Content type pks keyed by database alias.
+        self.content_type_ids = {}
+        self.select_subclasses_plans = None
+
+    def get_dispatch(self):
+        """
+        Return a content type pk to accessor dispatch table that is discarded
+        when either the content types or the app registry caches are cleared.
+        """
+        dispatch = self.dispatch
+        content_types_cache = get_content_types_cache()
+        fields_cache = self.model._meta._get_fields_cache
+        if (
+            dispatch is None
+            or dispatch.content_types_cache is not content_types_cache
+            or dispatch.fields_cache is not fields_cache
+        ):
+            dispatch = self.dispatch = ContentTypeDispatch(
+                self, content_types_cache, fields_cache
+            )
+        return dispatch
+
+    def get_content_type_ids(self, using=None):
+        """
+        Return the frozen set of the content type pks of the model and its
+        subclasses in database `using`, defaulting to the one
+        `ContentType.objects` reads from, that is discarded when the content
+        types cache of this database is cleared.
+        """
+        manager = ContentType.objects.db_manager(using)
+        alias = manager.db
+        content_types_cache = get_content_types_cache(alias)
+        content_type_ids = self.content_type_ids.get(alias)
+        if content_type_ids is None or content_type_ids[0] is not content_types_cache:
+            content_types = manager.get_for_models(*self, for_concrete_models=False)
+            pks = frozenset(ct.pk for ct in content_types.values())
+            # Retrieve the cache after the content types as it might have
+            # been created in the process.
+            content_type_ids = self.content_type_ids[alias] = (
+                get_content_types_cache(alias),
+                pks,
+            )
+        return content_type_ids[1]
+
+    def get_select_subclasses_plan(self, models):
+        """
+        Return the subclasses, content type filter, and `select_related`
+        structure required to select `models` which are computed only once
+        until the content types cache is cleared.
+        """
+        plans = self.select_subclasses_plans
+        if plans is None or plans[0] is not get_content_types_cache():
+            plans = self.select_subclasses_plans = (get_content_types_cache(), {})
+        key = frozenset(models)
+        try:
+            return plans[1][key]
+        except KeyError:
+            pass
+        owner = self.model
+        if models:
+            subclasses = {}
+            for model in models:
+                if not issubclass(model, owner):
+                    raise TypeError("%r is not a subclass of %r" % (model, owner))
+                subclasses.update(model.subclass_accessors)
+            content_type_filter = owner.content_type_lookup(*subclasses)
+            content_type_filter = {
+                lookup: frozenset(value)
+                for lookup, value in content_type_filter.items()
+            }
+        else:
+            subclasses = self
+            content_type_filter = None
+        related_lookups = tuple(sorted(get_related_lookups(self, subclasses)))
+        select_related = {}
+        for related_lookup in related_lookups:
+            node = select_related
+            for part in related_lookup.split(LOOKUP_SEP):
+                node = node.setdefault(part, {})
+        plan = plans[1][key] = SelectSubclassesPlan(
+            tuple(subclasses), content_type_filter, related_lookups, select_related
+        )
+        # The content types cache might have been created in the process.
+        content_types_cache = get_content_types_cache()
+        if plans[0] is not content_types_cache:
+            self.select_subclasses_plans = (content_types_cache, plans[1])
+        return plan
+
+
+class InheritanceIndex:
+    """
+    Immutable index of the inheritance tree of the subclasses of a model built
+    in a single pass over the installed models.
+    """
+
+    def __init__(self, base, models):
+        models = [model for model in models if issubclass(model, base)]
+        children = defaultdict(list)
+        for model in models:
+            opts = model._meta
+            if opts.proxy:
+                # Proxies are children of their concrete model and of all the
+                # proxies they inherit from.
+                for parent in model.__mro__[1:]:
+                    if (
+                        issubclass(parent, base)
+                        and not parent._meta.abstract
+                        and parent._meta.concrete_model is opts.concrete_model
+                    ):
+                        children[parent].append(model)
+            else:
+                for parent, parent_link in opts.parents.items():
+                    if parent_link:
+                        children[parent].append(model)
+        self.base = base
+        self.children = {
+            parent: tuple(parent_children)
+            for parent, parent_children in children.items()
+        }
+        accessors = {}
+        for model in models:
+            self._build_accessors(model, accessors)
+        # Accessors are never altered once the index is built which allows
+        # them to be shared between threads without locking.
+        self.accessors = MappingProxyType(accessors)
+
+    def _build_accessors(self, owner, built):
+        try:
+            return built[owner]
+        except KeyError:
+            pass
+        accessors = ModelSubclassAccessors(owner, {owner: EMPTY_ACCESSOR})
+        for child in self.children.get(owner, ()):
+            if child._meta.proxy:
+                accessors[child] = SubclassAccessor((), child, "")
+                continue
+            part = child._meta.model_name
+            child_accessors = self._build_accessors(child, built)
+            for model, (parts, proxy, _lookup) in child_accessors.items():
+                accessors[model] = SubclassAccessor(
+                    (part,) + parts, proxy, LOOKUP_SEP.join((part,) + parts)
+                )
+        built[owner] = accessors
+        return accessors
+
+
 class SubclassAccessors(defaultdict):
     def __init__(self):
         self.model = None
         self.apps = None
+        self.index = None
+        self.lock = threading.RLock()
 
     def contribute_to_class(self, model, name, **kwargs):
         self.model = model
         self.apps = model._meta.apps
-        self.lock = threading.RLock()
         setattr(model, name, self)
         # Ideally we would connect to the model.apps.clear_cache()
         class_prepared.connect(self.class_prepared_receiver, weak=False)
 
     def class_prepared_receiver(self, sender, **kwargs):
         if issubclass(sender, self.model):
-            with self.lock:
-                for parent in sender._meta.parents:
-                    self.pop(self.get_model_key(parent._meta), None)
+            self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.index = None
+            super().clear()
 
     def get_model_key(self, opts):
         return opts.app_label, opts.model_name
 
+    def get_index(self):
+        """
+        Return the inheritance index of the subclasses of the model, building
+        it if it was invalidated.
+        """
+        index = self.index
+        if index is None:
+            with self.lock:
+                index = self.index
+                if index is None:
+                    index = self.index = InheritanceIndex(
+                        self.model, self.apps.get_models()
+                    )
+        return index
+
     def __get__(self, instance, owner):
         if owner is self.model:
             return self
@@ -77,32 +307,18 @@ class SubclassAccessors(defaultdict):
 
     def __missing__(self, model_key):
         """
-        Generate the accessors for this model by recursively generating its
-        children accessors and prefixing them.
+        Retrieve the accessors of a model from the inheritance index. Reads of
+        already retrieved accessors never acquire the lock.
         """
         owner = self.apps.get_model(*model_key)
         if not issubclass(owner, self.model):
-            raise KeyError
-        accessors = {owner: EMPTY_ACCESSOR}
+            raise KeyError(model_key)
+        index = self.get_index()
+        accessors = index.accessors[owner]
         with self.lock:
-            for model in self.apps.get_models():
-                opts = model._meta
-                if (
-                    opts.proxy
-                    and issubclass(model, owner)
-                    and (owner._meta.proxy or opts.concrete_model is owner)
-                ):
-                    accessors[model] = SubclassAccessor((), model, "")
-                # Use .get() instead of `in` as proxy inheritance is also
-                # stored in _meta.parents as None.
-                elif opts.parents.get(owner):
-                    part = opts.model_name
-                    for child, (parts, proxy, _lookup) in self[
-                        self.get_model_key(opts)
-                    ].items():
-                        accessors[child] = SubclassAccessor(
-                            (part,) + parts, proxy, LOOKUP_SEP.join((part,) + parts)
-                        )
+            # Don't publish accessors of an index invalidated in the meantime.
+            if self.index is index:
+                self[model_key] = accessors
         return accessors
 
 
@@ -115,12 +331,26 @@ class BasePolymorphicModel(models.Model):
     def type_cast(self, to=None, with_prefetched_objects=False):
         if to is None:
             content_type_id = getattr(self, "%s_id" % self.CONTENT_TYPE_FIELD)
-            to = ContentType.objects.get_for_id(content_type_id).model_class()
-        accessor = self.subclass_accessors[to]
+            accessor = self.subclass_accessors.get_dispatch()[content_type_id]
+        else:
+            accessor = self.subclass_accessors[to]
+        return accessor(self, with_prefetched_objects)
+
+    async def atype_cast(self, to=None, with_prefetched_objects=False):
+        # Avoid a trip to a synchronous thread when type casting doesn't
+        # involve any database query.
+        if to is None:
+            content_type_id = getattr(self, "%s_id" % self.CONTENT_TYPE_FIELD)
+            accessor = self.subclass_accessors.get_dispatch().get(content_type_id)
+        else:
+            accessor = self.subclass_accessors[to]
+        if accessor is None or not accessor.is_cached(self):
+            return await sync_to_async(self.type_cast)(to, with_prefetched_objects)
         return accessor(self, with_prefetched_objects)
 
     def save(self, *args, **kwargs):
         if self._state.adding and getattr(self, self.CONTENT_TYPE_FIELD, None) is None:
+            ensure_content_types_snapshot_validated()
             content_type = get_content_type(self.__class__)
             setattr(self, self.CONTENT_TYPE_FIELD, content_type)
         return super().save(*args, **kwargs)
@@ -140,6 +370,7 @@ class BasePolymorphicModel(models.Model):
         with context_manager:
             deletion = super().delete(using=using, keep_parents=keep_parents)
             if kept_parent:
+                ensure_content_types_snapshot_validated()
                 parent_content_type = get_content_type(kept_parent)
                 setattr(kept_parent, self.CONTENT_TYPE_FIELD, parent_content_type)
                 kept_parent.save(update_fields=[self.CONTENT_TYPE_FIELD])
@@ -156,10 +387,9 @@ class BasePolymorphicModel(models.Model):
         return {query_name: value}
 
     @classmethod
-    def subclasses_lookup(cls, query_name=None):
-        return cls.content_type_lookup(
-            cls, *tuple(cls.subclass_accessors), query_name=query_name
-        )
+    def subclasses_lookup(cls, query_name=None, using=None):
+        query_name = "%s__in" % (query_name or cls.CONTENT_TYPE_FIELD)
+        return {query_name: cls.subclass_accessors.get_content_type_ids(using)}
 
     @classmethod
     def check(cls, **kwargs):
@@ -0,0 +1,132 @@
+import json
+import threading
+
+SNAPSHOT_VERSION = 1
+
+# Snapshot entries added to the content types cache that have yet to be
+# validated against their database keyed by alias.
+unvalidated_snapshots = {}
+validation_lock = threading.Lock()
+
+
+def get_model_keys(models):
+    return {(model._meta.app_label, model._meta.model_name) for model in models}
+
+
+def dump_content_types_snapshot(models, using, fp):
+    """
+    Write a snapshot of the content type pks of `models` in the databases
+    `using` to `fp`. Missing content types are created.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    databases = {}
+    for alias in using:
+        content_types = ContentType.objects.db_manager(alias).get_for_models(
+            *models, for_concrete_models=False
+        )
+        databases[alias] = sorted(
+            [content_type.app_label, content_type.model, content_type.pk]
+            for content_type in content_types.values()
+        )
+    json.dump(
+        {"version": SNAPSHOT_VERSION, "databases": databases},
+        fp,
+        separators=(",", ":"),
+    )
+
+
+def load_content_types_snapshot(path, models):
+    """
+    Load the snapshot stored at `path` and return a mapping of database
+    aliases to `(app_label, model, pk)` entries or `None` if the snapshot is
+    missing, invalid, or doesn't cover exactly `models`.
+    """
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    keys = get_model_keys(models)
+    databases = {}
+    try:
+        for alias, entries in snapshot["databases"].items():
+            entries = [
+                (str(app_label), str(model), int(pk))
+                for app_label, model, pk in entries
+            ]
+            if {(app_label, model) for app_label, model, _pk in entries} != keys:
+                return None
+            databases[alias] = entries
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return databases
+
+
+def cache_content_types_snapshot(snapshot):
+    """
+    Add the content types of a loaded snapshot to the content types cache
+    without querying the database. They are validated against their database
+    before any content type is written to it.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    from .utils import get_content_types_cache
+
+    field_names = ["id", "app_label", "model"]
+    for alias, entries in snapshot.items():
+        manager = ContentType.objects.db_manager(alias)
+        for app_label, model, pk in entries:
+            content_type = ContentType.from_db(
+                alias, field_names, (pk, app_label, model)
+            )
+            manager._add_to_cache(alias, content_type)
+        unvalidated_snapshots[alias] = (get_content_types_cache(alias), entries)
+
+
+def ensure_content_types_snapshot_validated(using=None):
+    """
+    Validate the snapshot entries cached for database `using`, defaulting to
+    the one `ContentType.objects` reads from, if they haven't been yet. Writes
+    of content types must be preceded by a call to this function.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    from .utils import get_content_types_cache
+
+    alias = using or ContentType.objects.db
+    if alias not in unvalidated_snapshots:
+        return
+    with validation_lock:
+        try:
+            content_types_cache, entries = unvalidated_snapshots[alias]
+        except KeyError:
+            return
+        # Entries cleared from the cache since don't have to be validated.
+        if get_content_types_cache(alias) is content_types_cache:
+            validate_content_types_snapshot({alias: entries})
+        del unvalidated_snapshots[alias]
+
+
+def validate_content_types_snapshot(snapshot):
+    """
+    Make sure the content types of a loaded snapshot match the ones stored in
+    their databases and clear the content types cache otherwise. Return
+    whether or not the snapshot is valid.
+    """
+    from django.contrib.contenttypes.models import ContentType
+
+    for alias, entries in snapshot.items():
+        expected = {pk: (app_label, model) for app_label, model, pk in entries}
+        actual = {
+            pk: (app_label, model)
+            for pk, app_label, model in ContentType.objects.using(alias)
+            .filter(pk__in=expected)
+            .values_list("pk", "app_label", "model")
+        }
+        if actual != expected:
+            ContentType.objects.clear_cache()
+            return False
+    return True
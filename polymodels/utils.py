@@ -1,17 +1,65 @@
 from functools import partial
 
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.base import ModelState
+
+
+def copy_state(src):
+    """
+    Return a copy of the `ModelState` of `src` that doesn't share its related
+    objects cache.
+    """
+    state = ModelState()
+    src_state = src._state
+    state.db = src_state.db
+    state.adding = src_state.adding
+    state.fields_cache = src_state.fields_cache.copy()
+    return state
 
 
 def copy_fields(src, to):
     """
     Returns a new instance of `to_cls` with fields data fetched from `src`.
     Useful for getting a model proxy instance from concrete model instance or
-    the other way around. Note that we use *arg calling to get a faster model
+    the other way around.
+
+    When both models share the same concrete model the instance attributes of
+    `src` are transferred as is which avoids a full model initialization and
+    preserves its database state, related objects cache, deferred fields, and
+    annotations. Otherwise *arg calling is used to get a faster model
     initialization.
     """
-    args = tuple(getattr(src, field.attname) for field in src._meta.fields)
-    return to(*args)
+    if src._meta.concrete_model is not to._meta.concrete_model:
+        args = tuple(getattr(src, field.attname) for field in src._meta.fields)
+        return to(*args)
+    obj = to.__new__(to)
+    obj.__dict__.update(src.__dict__)
+    obj._state = copy_state(src)
+    prefetched_objects_cache = src.__dict__.get("_prefetched_objects_cache")
+    if prefetched_objects_cache is not None:
+        obj._prefetched_objects_cache = prefetched_objects_cache.copy()
+    return obj
+
+
+def copy_prefetched_objects(src, to):
+    """
+    Make the objects prefetched on `src` available on `to`.
+    """
+    try:
+        to._prefetched_objects_cache.update(src._prefetched_objects_cache)
+    except AttributeError:
+        to._prefetched_objects_cache = src._prefetched_objects_cache
+
+
+def get_content_types_cache(using=None):
+    """
+    Return the `ContentType` cache of database `using`, defaulting to the one
+    `ContentType.objects` reads from. A new one is created each time
+    `ContentType.objects.clear_cache()` is called which makes its identity
+    suitable to invalidate data derived from content types.
+    """
+    manager = ContentType.objects
+    return manager._cache.get(using or manager.db)
 
 
 get_content_type = partial(ContentType.objects.get_for_model, for_concrete_model=False)
@@ -187,4 +187,53 @@ class Migration(migrations.Migration):
             options={"proxy": True, "indexes": []},
             bases=("tests.bigsnake",),
         ),
+        migrations.CreateModel(
+            name="Toy",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "content_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="contenttypes.ContentType",
+                    ),
+                ),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="toys",
+                        to="tests.Animal",
+                    ),
+                ),
+            ],
+            options={"ordering": ["id"]},
+        ),
+        migrations.CreateModel(
+            name="Ball",
+            fields=[
+                (
+                    "toy_ptr",
+                    models.OneToOneField(
+                        auto_created=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        parent_link=True,
+                        primary_key=True,
+                        serialize=False,
+                        to="tests.Toy",
+                    ),
+                )
+            ],
+            options={"abstract": False},
+            bases=("tests.toy",),
+        ),
     ]
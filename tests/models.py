@@ -69,3 +69,14 @@ class BigSnake(Snake):
 class HugeSnake(BigSnake):
     class Meta:
         proxy = True
+
+
+class Toy(PolymorphicModel):
+    owner = models.ForeignKey(Animal, models.CASCADE, related_name="toys")
+
+    class Meta:
+        ordering = ["id"]
+
+
+class Ball(Toy):
+    pass
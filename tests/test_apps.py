@@ -0,0 +1,199 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.test import override_settings
+
+from polymodels.apps import preload_content_types
+from polymodels.models import BasePolymorphicModel
+from polymodels.snapshot import (
+    cache_content_types_snapshot,
+    ensure_content_types_snapshot_validated,
+    load_content_types_snapshot,
+    unvalidated_snapshots,
+    validate_content_types_snapshot,
+)
+
+from .base import TestCase
+from .models import Animal, BigSnake, Mammal, Zoo
+
+
+class PolymodelsConfigTests(TestCase):
+    def setUp(self):
+        self.app_config = apps.get_app_config("polymodels")
+
+    def test_preload_content_types(self):
+        with self.assertNumQueries(1):
+            preload_content_types([Animal, Mammal, BigSnake], connection.alias)
+        with self.assertNumQueries(0):
+            ContentType.objects.get_for_models(
+                Animal, Mammal, BigSnake, for_concrete_models=False
+            )
+        with self.assertNumQueries(1):
+            ContentType.objects.get_for_model(Zoo)
+
+    def test_connection_created_receiver(self):
+        with mock.patch.object(self.app_config, "warmed_up_aliases", set()):
+            with self.assertNumQueries(1):
+                self.app_config.connection_created_receiver(connection=connection)
+            # Content types are only preloaded on the first connection.
+            ContentType.objects.clear_cache()
+            with self.assertNumQueries(0):
+                self.app_config.connection_created_receiver(connection=connection)
+
+    def test_connection_created_receiver_no_db_alias(self):
+        # Such connections are opened to create and destroy test databases.
+        nodb_connection = type(connections[DEFAULT_DB_ALIAS])(
+            connection.settings_dict, alias=NO_DB_ALIAS
+        )
+        self.addCleanup(nodb_connection.close)
+        with mock.patch.object(self.app_config, "warmed_up_aliases", set()):
+            nodb_connection.ensure_connection()
+            self.assertEqual(self.app_config.warmed_up_aliases, set())
+
+    @override_settings(POLYMODELS_WARMUP=False)
+    def test_disabled(self):
+        with mock.patch("polymodels.apps.connection_created") as connection_created:
+            self.app_config.ready()
+        connection_created.connect.assert_not_called()
+
+
+class ContentTypesSnapshotTests(TestCase):
+    def setUp(self):
+        self.models = BasePolymorphicModel.subclass_accessors.get_index().accessors
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "snapshot.json")
+        stdout = StringIO()
+        call_command("polymodels_snapshot", self.path, stdout=stdout)
+        self.assertIn(
+            "Wrote the content types of %d polymorphic models" % len(self.models),
+            stdout.getvalue(),
+        )
+        ContentType.objects.clear_cache()
+        patcher = mock.patch.dict(unvalidated_snapshots)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, snapshot):
+        with open(self.path, "w") as fp:
+            json.dump(snapshot, fp)
+
+    def test_load(self):
+        snapshot = load_content_types_snapshot(self.path, self.models)
+        self.assertEqual(list(snapshot), ["default"])
+        cache_content_types_snapshot(snapshot)
+        with self.assertNumQueries(0):
+            content_types = ContentType.objects.get_for_models(
+                *self.models, for_concrete_models=False
+            )
+            self.assertEqual(
+                ContentType.objects.get_for_id(content_types[Mammal].pk),
+                content_types[Mammal],
+            )
+        self.assertTrue(validate_content_types_snapshot(snapshot))
+        self.assertEqual(
+            ContentType.objects.get_for_model(Mammal),
+            ContentType.objects.get(app_label="tests", model="mammal"),
+        )
+
+    def test_load_stale(self):
+        self.assertIsNone(load_content_types_snapshot(self.path, [Animal, Mammal]))
+        self.assertIsNone(load_content_types_snapshot(self.path + ".missing", []))
+        with open(self.path) as fp:
+            snapshot = json.load(fp)
+        self.write(dict(snapshot, version=0))
+        self.assertIsNone(load_content_types_snapshot(self.path, self.models))
+        self.write({"version": 1, "databases": {"default": [["tests"]]}})
+        self.assertIsNone(load_content_types_snapshot(self.path, self.models))
+        # Snapshots with pks that don't match the database are invalidated.
+        for entry in snapshot["databases"]["default"]:
+            entry[2] += 1000
+        self.write(snapshot)
+        snapshot = load_content_types_snapshot(self.path, self.models)
+        cache_content_types_snapshot(snapshot)
+        self.assertFalse(validate_content_types_snapshot(snapshot))
+        mammal_content_type = ContentType.objects.get(app_label="tests", model="mammal")
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                ContentType.objects.get_for_model(Mammal), mammal_content_type
+            )
+
+    def test_ensure_validated(self):
+        snapshot = load_content_types_snapshot(self.path, self.models)
+        cache_content_types_snapshot(snapshot)
+        self.assertEqual(list(unvalidated_snapshots), ["default"])
+        with self.assertNumQueries(1):
+            ensure_content_types_snapshot_validated()
+        with self.assertNumQueries(0):
+            ensure_content_types_snapshot_validated()
+        # Entries cleared from the cache don't have to be validated.
+        cache_content_types_snapshot(snapshot)
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(0):
+            ensure_content_types_snapshot_validated()
+        self.assertEqual(unvalidated_snapshots, {})
+
+    def test_app_config(self):
+        app_config = apps.get_app_config("polymodels")
+        with mock.patch.object(
+            app_config, "warmed_up_aliases", set()
+        ), mock.patch.object(app_config, "snapshot", {}):
+            app_config.load_snapshot(self.path, self.models)
+            self.assertEqual(list(app_config.snapshot), ["default"])
+            # Snapshotted content types are used without querying the database.
+            with self.assertNumQueries(0):
+                app_config.connection_created_receiver(connection=connection)
+                ContentType.objects.get_for_model(Animal)
+            self.assertEqual(app_config.warmed_up_aliases, {"default"})
+            # A single query validates them before the first write.
+            with self.assertNumQueries(2):
+                Animal.objects.create(name="animal")
+            with self.assertNumQueries(1):
+                Animal.objects.create(name="animal")
+
+    def test_app_config_stale(self):
+        with open(self.path) as fp:
+            snapshot = json.load(fp)
+        for entry in snapshot["databases"]["default"]:
+            entry[2] += 1000
+        self.write(snapshot)
+        mammal_content_type = ContentType.objects.get(app_label="tests", model="mammal")
+        app_config = apps.get_app_config("polymodels")
+        with mock.patch.object(
+            app_config, "warmed_up_aliases", set()
+        ), mock.patch.object(app_config, "snapshot", {}):
+            app_config.load_snapshot(self.path, self.models)
+            with self.assertNumQueries(0):
+                app_config.connection_created_receiver(connection=connection)
+            # Stale snapshots are discarded before any content type is written.
+            mammal = Mammal.objects.create(name="mammal")
+            self.assertEqual(mammal.content_type_id, mammal_content_type.pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                    ContentType.objects.get_for_model(Mammal), mammal_content_type
+                )
+
+    def test_app_config_warmup_disabled(self):
+        app_config = apps.get_app_config("polymodels")
+        with override_settings(
+            POLYMODELS_WARMUP=False, POLYMODELS_CONTENT_TYPES_SNAPSHOT=self.path
+        ), mock.patch.object(app_config, "snapshot", {}), mock.patch(
+            "polymodels.apps.connection_created"
+        ) as connection_created:
+            app_config.ready()
+        connection_created.connect.assert_not_called()
+        # Snapshots are loaded even when content types aren't preloaded.
+        with self.assertNumQueries(0):
+            ContentType.objects.get_for_model(Animal)
+
+    def test_command_requires_path(self):
+        with self.assertRaisesMessage(CommandError, "A path must be provided"):
+            call_command("polymodels_snapshot")
@@ -1,6 +1,21 @@
-from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+import gc
+import tracemalloc
+from unittest import mock
 
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    FieldError,
+    ImproperlyConfigured,
+)
+from django.db import connection, models
+from django.db.models import Prefetch
+from django.db.models.functions import Upper
+from django.db.models.query import ModelIterable
+from django.test.utils import CaptureQueriesContext
+
+import polymodels
+from polymodels import managers
 from polymodels.managers import PolymorphicManager
 
 from .base import TestCase
@@ -91,6 +106,432 @@ class PolymorphicQuerySetTest(TestCase):
                 transform=repr,
             )
 
+    def test_select_subclasses_adaptive(self):
+        Animal.objects.create(name="animal")
+        Mammal.objects.create(name="mammal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        HugeSnake.objects.create(name="huge snake", length=155)
+        animals = Animal.objects.select_subclasses(strategy="adaptive")
+        self.assertFalse(animals.query.select_related)
+        with self.assertNumQueries(2) as ctx:
+            self.assertQuerySetEqual(
+                animals.filter(name__contains="snake"),
+                ["<Snake: snake>", "<HugeSnake: huge snake>"],
+                transform=repr,
+            )
+        self.assertIn("DISTINCT", ctx.captured_queries[0]["sql"])
+        self.assertIn('"tests_snake"', ctx.captured_queries[1]["sql"])
+        self.assertNotIn('"tests_mammal"', ctx.captured_queries[1]["sql"])
+        # Only the base table is queried when no subclasses are present.
+        with self.assertNumQueries(2) as ctx:
+            self.assertQuerySetEqual(
+                animals.filter(name="animal"), ["<Animal: animal>"], transform=repr
+            )
+        self.assertNotIn("JOIN", ctx.captured_queries[1]["sql"])
+        # The content types are only retrieved once per queryset.
+        mammals = animals.filter(name__startswith="m")
+        with self.assertNumQueries(3):
+            self.assertQuerySetEqual(
+                list(mammals.iterator()),
+                ["<Mammal: mammal>", "<Monkey: monkey>"],
+                transform=repr,
+            )
+            self.assertQuerySetEqual(
+                list(mammals.iterator()),
+                ["<Mammal: mammal>", "<Monkey: monkey>"],
+                transform=repr,
+            )
+        # Sliced querysets join all the selected subclasses.
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                Animal.objects.select_subclasses(Mammal, strategy="adaptive")[1:],
+                ["<Monkey: monkey>"],
+                transform=repr,
+            )
+
+    def test_select_subclasses_per_type(self):
+        Animal.objects.create(name="animal")
+        Mammal.objects.create(name="mammal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        BigSnake.objects.create(name="big snake", length=101)
+        HugeSnake.objects.create(name="huge snake", length=155)
+        animals = Animal.objects.select_subclasses(strategy="per_type")
+        self.assertFalse(animals.query.select_related)
+        expected = [
+            "<Animal: animal>",
+            "<Mammal: mammal>",
+            "<Monkey: monkey>",
+            "<Snake: snake>",
+            "<BigSnake: big snake>",
+            "<HugeSnake: huge snake>",
+        ]
+        # One query for the base rows and one for each subclass.
+        with self.assertNumQueries(6):
+            self.assertQuerySetEqual(animals.all(), expected, transform=repr)
+        with self.assertNumQueries(6):
+            self.assertQuerySetEqual(
+                list(animals.iterator(chunk_size=10)), expected, transform=repr
+            )
+        # One query for the base rows and one for each subclass in each chunk.
+        with self.assertNumQueries(6):
+            self.assertQuerySetEqual(
+                list(animals.iterator(chunk_size=2)), expected, transform=repr
+            )
+        snakes = Animal.objects.select_subclasses(Snake, strategy="per_type")
+        with self.assertNumQueries(4):
+            self.assertQuerySetEqual(
+                snakes.order_by("-name"),
+                ["<Snake: snake>", "<HugeSnake: huge snake>", "<BigSnake: big snake>"],
+                transform=repr,
+            )
+        # Proxies of the queryset's model don't require extra queries.
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                Snake.objects.select_subclasses(strategy="per_type"),
+                ["<Snake: snake>", "<BigSnake: big snake>", "<HugeSnake: huge snake>"],
+                transform=repr,
+            )
+
+    def test_select_subclasses_per_type_duplicate_rows(self):
+        monkey = Monkey.objects.create(name="monkey")
+        zoos = [Zoo.objects.create(), Zoo.objects.create()]
+        for zoo in zoos:
+            zoo.animals.add(monkey)
+        animals = (
+            Animal.objects.filter(zoos__in=zoos)
+            .annotate(zoo=models.F("zoos"))
+            .order_by("zoo")
+        )
+        for strategy in ("join", "per_type"):
+            with self.subTest(strategy=strategy):
+                objs = list(animals.select_subclasses(strategy=strategy))
+                self.assertEqual(list(map(type, objs)), [Monkey, Monkey])
+                self.assertIsNot(objs[0], objs[1])
+                self.assertEqual([obj.zoo for obj in objs], [zoo.pk for zoo in zoos])
+
+    def test_select_subclasses_union(self):
+        Animal.objects.create(name="animal")
+        Mammal.objects.create(name="mammal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10, color="green")
+        BigSnake.objects.create(name="big snake", length=101)
+        HugeSnake.objects.create(name="huge snake", length=155)
+        animals = Animal.objects.select_subclasses(strategy="union")
+        self.assertFalse(animals.query.select_related)
+        with self.assertNumQueries(1) as ctx:
+            self.assertQuerySetEqual(
+                animals.all(),
+                [
+                    "<Animal: animal>",
+                    "<Mammal: mammal>",
+                    "<Monkey: monkey>",
+                    "<Snake: snake>",
+                    "<BigSnake: big snake>",
+                    "<HugeSnake: huge snake>",
+                ],
+                transform=repr,
+            )
+        sql = ctx.captured_queries[0]["sql"]
+        self.assertEqual(sql.count("UNION ALL"), 3)
+        # Columns missing from a branch are padded with typed NULLs.
+        self.assertIn("CAST(NULL AS", sql)
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                animals.order_by("-name")[1:4],
+                ["<Monkey: monkey>", "<Mammal: mammal>", "<HugeSnake: huge snake>"],
+                transform=repr,
+            )
+        with self.assertNumQueries(1):
+            snake = animals.get(name="snake")
+            self.assertEqual((snake.length, snake.color), (10, "green"))
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                Animal.objects.select_subclasses(Mammal, strategy="union")
+                .annotate(upper_name=Upper("name"))
+                .filter(name__startswith="m"),
+                [("MAMMAL", Mammal), ("MONKEY", Monkey)],
+                transform=lambda animal: (animal.upper_name, type(animal)),
+            )
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                list(Mammal.objects.select_subclasses(strategy="union").iterator()),
+                ["<Mammal: mammal>", "<Monkey: monkey>"],
+                transform=repr,
+            )
+
+    def test_select_subclasses_union_fallback(self):
+        Animal.objects.create(name="animal")
+        Monkey.objects.create(name="monkey")
+        animals = Animal.objects.select_subclasses(strategy="union")
+        # Querysets that cannot be expressed as a union use per type queries.
+        for queryset in [
+            animals.select_related("content_type"),
+            animals.defer("name"),
+            animals.order_by("?"),
+            animals.order_by("content_type"),
+        ]:
+            with self.subTest(query=str(queryset.query)):
+                with self.assertNumQueries(2):
+                    self.assertCountEqual(map(type, queryset), [Animal, Monkey])
+
+    def test_select_subclasses_deferred_content_type(self):
+        Animal.objects.create(name="animal")
+        for name in ("a", "b"):
+            Monkey.objects.create(name="%s monkey" % name)
+            Snake.objects.create(name="%s snake" % name, length=10)
+        expected = [Animal, Monkey, Snake, Monkey, Snake]
+        # The content type column is always loaded to avoid refreshing it for
+        # each object.
+        querysets = []
+        for strategy, num_queries in [
+            ("join", 1),
+            ("adaptive", 2),
+            ("per_type", 3),
+            ("union", 3),
+            ("leaf", 1),
+        ]:
+            animals = Animal.objects.select_subclasses(strategy=strategy)
+            querysets.append((animals.defer("content_type"), num_queries))
+            # Only fields cannot be combined with the joins of other strategies.
+            if strategy in ("per_type", "union"):
+                querysets.append((animals.only("name"), num_queries))
+        for queryset, num_queries in querysets:
+            with self.subTest(query=str(queryset.query)):
+                with self.assertNumQueries(num_queries):
+                    objs = list(queryset)
+                self.assertEqual(list(map(type, objs)), expected)
+                self.assertEqual(objs[1].name, "a monkey")
+
+    def test_select_subclasses_chunked_cast(self):
+        for name in ("a", "b", "c"):
+            Monkey.objects.create(name="%s monkey" % name)
+            Snake.objects.create(name="%s snake" % name, length=10)
+            BigSnake.objects.create(name="%s big snake" % name, length=101)
+        animals = Animal.objects.select_subclasses().order_by("name")
+        expected = [
+            "<BigSnake: a big snake>",
+            "<Monkey: a monkey>",
+            "<Snake: a snake>",
+            "<BigSnake: b big snake>",
+            "<Monkey: b monkey>",
+            "<Snake: b snake>",
+            "<BigSnake: c big snake>",
+            "<Monkey: c monkey>",
+            "<Snake: c snake>",
+        ]
+        for chunk_size in (1, 2, 4, 100):
+            with self.subTest(chunk_size=chunk_size), self.assertNumQueries(1):
+                self.assertQuerySetEqual(
+                    list(animals.iterator(chunk_size=chunk_size)),
+                    expected,
+                    transform=repr,
+                )
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(animals, expected, transform=repr)
+
+    def test_select_subclasses_leaf(self):
+        Animal.objects.create(name="animal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        BigSnake.objects.create(name="big snake", length=101)
+        animals = Animal.objects.select_subclasses(strategy="leaf").order_by("name")
+        expected = [
+            "<Animal: animal>",
+            "<BigSnake: big snake>",
+            "<Monkey: monkey>",
+            "<Snake: snake>",
+        ]
+        with self.assertNumQueries(1):
+            objs = list(animals)
+        self.assertQuerySetEqual(objs, expected, transform=repr)
+        # Objects are instantiated without intermediary parent instances.
+        self.assertEqual(objs[2]._state.fields_cache, {})
+        self.assertEqual(objs[3].length, 10)
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                animals.iterator(chunk_size=1), expected, transform=repr
+            )
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                [obj.upper for obj in animals.annotate(upper=Upper("name"))],
+                ["ANIMAL", "BIG SNAKE", "MONKEY", "SNAKE"],
+            )
+        mammals = Animal.objects.select_subclasses(Mammal, strategy="leaf")
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                mammals,
+                ["<Monkey: monkey>"],
+                transform=repr,
+            )
+        # Deferred fields fallback to the join strategy.
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(map(type, animals.defer("name"))),
+                [Animal, BigSnake, Monkey, Snake],
+            )
+
+    def test_select_subclasses_lean(self):
+        Monkey.objects.create(name="monkey")
+        BigSnake.objects.create(name="big snake", length=101)
+        animals = Animal.objects.select_subclasses(lean=True).order_by("name")
+        self.assertIs(animals.filter(name="monkey")._lean_cast, True)
+        with self.assertNumQueries(1):
+            objs = list(animals)
+        self.assertQuerySetEqual(
+            objs, ["<BigSnake: big snake>", "<Monkey: monkey>"], transform=repr
+        )
+        self.assertEqual(objs[0]._state.fields_cache, {})
+        self.assertEqual(objs[1]._state.fields_cache, {})
+        # Parent instances are rebuilt from the subclass instance fields.
+        with self.assertNumQueries(0):
+            self.assertEqual(objs[1].mammal_ptr.name, "monkey")
+        with self.assertNumQueries(2):
+            self.assertQuerySetEqual(
+                animals.prefetch_related("zoos"),
+                ["<BigSnake: big snake>", "<Monkey: monkey>"],
+                transform=repr,
+            )
+
+    def test_select_subclasses_lean_memory(self):
+        Monkey.objects.bulk_create([Monkey(name="monkey %d" % i) for i in range(100)])
+
+        def get_allocated_bytes(queryset):
+            # Warm up caches.
+            list(queryset.all())
+            gc.collect()
+            tracemalloc.start()
+            self.addCleanup(tracemalloc.stop)
+            start = tracemalloc.get_traced_memory()[0]
+            objs = list(queryset.all())
+            gc.collect()
+            allocated = tracemalloc.get_traced_memory()[0] - start
+            tracemalloc.stop()
+            self.assertEqual(len(objs), 100)
+            return allocated
+
+        animals = Animal.objects.select_subclasses()
+        self.assertLess(
+            get_allocated_bytes(animals.select_subclasses(lean=True)),
+            get_allocated_bytes(animals) * 0.75,
+        )
+
+    def test_select_subclasses_max_join_depth(self):
+        Animal.objects.create(name="animal")
+        Mammal.objects.create(name="mammal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        BigSnake.objects.create(name="big snake", length=101)
+        expected = [
+            "<Animal: animal>",
+            "<BigSnake: big snake>",
+            "<Mammal: mammal>",
+            "<Monkey: monkey>",
+            "<Snake: snake>",
+        ]
+        animals = Animal.objects.order_by("name")
+        queryset = animals.select_subclasses(max_join_depth=1)
+        self.assertEqual(queryset.query.select_related, {"mammal": {}, "snake": {}})
+        # Monkeys are retrieved through a single query.
+        with self.assertNumQueries(2):
+            self.assertQuerySetEqual(queryset, expected, transform=repr)
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(
+                animals.select_subclasses(max_join_depth=2), expected, transform=repr
+            )
+        with self.assertNumQueries(5):
+            self.assertQuerySetEqual(
+                animals.select_subclasses(max_join_depth=0), expected, transform=repr
+            )
+        with self.assertRaisesMessage(
+            ValueError, "max_join_depth can only be used with the 'join' strategy."
+        ):
+            animals.select_subclasses(strategy="adaptive", max_join_depth=1)
+        with self.assertRaisesMessage(
+            ValueError, "max_join_depth must be a non-negative integer."
+        ):
+            animals.select_subclasses(max_join_depth=-1)
+
+    def test_type_cast_many(self):
+        Animal.objects.create(name="animal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        BigSnake.objects.create(name="big snake", length=101)
+        zoo = Zoo.objects.create()
+        zoo.animals.set(Animal.objects.all())
+        expected = [
+            "<Animal: animal>",
+            "<BigSnake: big snake>",
+            "<Monkey: monkey>",
+            "<Snake: snake>",
+        ]
+        objs = list(Animal.objects.order_by("name").prefetch_related("zoos"))
+        # A single query is issued per content type.
+        with self.assertNumQueries(3):
+            casted = polymodels.type_cast_many(objs, with_prefetched_objects=True)
+        self.assertQuerySetEqual(casted, expected, transform=repr)
+        with self.assertNumQueries(0):
+            for obj in casted:
+                self.assertEqual(list(obj.zoos.all()), [zoo])
+        with self.assertNumQueries(0):
+            self.assertEqual(polymodels.type_cast_many(casted), casted)
+        with self.assertNumQueries(4):
+            self.assertQuerySetEqual(
+                Animal.objects.type_cast_many(Animal.objects.order_by("name")),
+                expected,
+                transform=repr,
+            )
+        # Objects with already retrieved subclasses are casted without queries.
+        objs = list(Animal.objects.select_related("mammal__monkey").order_by("name"))
+        with self.assertNumQueries(2):
+            self.assertQuerySetEqual(
+                polymodels.type_cast_many(objs), expected, transform=repr
+            )
+
+    def test_select_subclasses_clone(self):
+        Monkey.objects.create(name="monkey")
+        animals = Animal.objects.all()
+        animals.select_subclasses(strategy="per_type")
+        self.assertIs(animals._iterable_class, ModelIterable)
+        queryset = animals.select_subclasses()
+        queryset.select_subclasses(strategy="per_type")
+        with self.assertNumQueries(1):
+            self.assertQuerySetEqual(queryset, ["<Monkey: monkey>"], transform=repr)
+
+    def test_select_subclasses_plan(self):
+        accessors = Animal.subclass_accessors
+        plan = accessors.get_select_subclasses_plan((Mammal, Snake))
+        self.assertIs(accessors.get_select_subclasses_plan((Snake, Mammal)), plan)
+        self.assertCountEqual(
+            plan.subclasses, [Mammal, Monkey, Snake, BigSnake, HugeSnake]
+        )
+        self.assertEqual(plan.related_lookups, ("mammal", "mammal__monkey", "snake"))
+        self.assertEqual(plan.select_related, {"mammal": {"monkey": {}}, "snake": {}})
+        with mock.patch("polymodels.models.get_content_types") as get_content_types:
+            queryset = Animal.objects.select_subclasses(Mammal, Snake)
+        get_content_types.assert_not_called()
+        self.assertEqual(queryset.query.select_related, plan.select_related)
+        self.assertEqual(queryset._selected_subclasses, plan.subclasses)
+        # Existing select_related structures are merged.
+        queryset = Animal.objects.select_related("content_type").select_subclasses(
+            Snake
+        )
+        self.assertEqual(
+            queryset.query.select_related, {"content_type": {}, "snake": {}}
+        )
+        # Plans are discarded when the content types cache is cleared.
+        ContentType.objects.clear_cache()
+        self.assertIsNot(accessors.get_select_subclasses_plan((Mammal, Snake)), plan)
+
+    def test_select_subclasses_invalid_strategy(self):
+        with self.assertRaisesMessage(
+            ValueError,
+            "'unknown' is not a valid select_subclasses strategy, choices are "
+            "'join', 'adaptive', 'per_type', 'union', 'leaf'.",
+        ):
+            Animal.objects.select_subclasses(strategy="unknown")
+
     def test_select_subclasses_get(self):
         snake = Snake.objects.create(name="snake", length=10)
         self.assertEqual(Animal.objects.select_subclasses().get(), snake)
@@ -167,6 +608,418 @@ class PolymorphicQuerySetTest(TestCase):
             self.assertSequenceEqual(queryset[2].friends.all(), [other_monkey])
             self.assertSequenceEqual(queryset[3].friends.all(), [monkey])
 
+    def test_select_subclasses_per_type_prefetch_related(self):
+        zoo = Zoo.objects.create()
+        animal = Animal.objects.create(name="animal")
+        monkey = Monkey.objects.create(name="monkey")
+        other_monkey = Monkey.objects.create(name="monkey")
+        zoo.animals.add(animal, monkey)
+        monkey.friends.add(other_monkey)
+        queryset = Animal.objects.select_subclasses(strategy="per_type")
+        queryset = queryset.prefetch_related("zoos", "mammal__monkey__friends")
+        with self.assertNumQueries(5):
+            self.assertSequenceEqual(queryset, [animal, monkey, other_monkey])
+            self.assertIsInstance(queryset[1], Monkey)
+            self.assertSequenceEqual(queryset[0].zoos.all(), [zoo])
+            self.assertSequenceEqual(queryset[1].zoos.all(), [zoo])
+            self.assertSequenceEqual(queryset[1].friends.all(), [other_monkey])
+            self.assertSequenceEqual(queryset[2].friends.all(), [monkey])
+
+    def test_prefetch_subclass_related(self):
+        zoo = Zoo.objects.create()
+        animal = Animal.objects.create(name="animal")
+        monkey = Monkey.objects.create(name="monkey")
+        other_monkey = Monkey.objects.create(name="other monkey")
+        zoo.animals.add(animal, monkey)
+        monkey.friends.add(other_monkey)
+        queryset = (
+            Animal.objects.select_subclasses()
+            .prefetch_related("zoos")
+            .prefetch_subclass_related(
+                Monkey, "friends", Prefetch("zoos", to_attr="monkey_zoos")
+            )
+        )
+        with self.assertNumQueries(4):
+            self.assertSequenceEqual(queryset, [animal, monkey, other_monkey])
+            self.assertSequenceEqual(queryset[0].zoos.all(), [zoo])
+            self.assertSequenceEqual(queryset[1].zoos.all(), [zoo])
+            self.assertSequenceEqual(queryset[1].friends.all(), [other_monkey])
+            self.assertSequenceEqual(queryset[2].friends.all(), [monkey])
+            self.assertEqual(queryset[1].monkey_zoos, [zoo])
+            self.assertEqual(queryset[2].monkey_zoos, [])
+            self.assertFalse(hasattr(queryset[0], "monkey_zoos"))
+        # The lookups are preserved on cloning and can be cleared.
+        queryset = queryset.filter(name__contains="monkey")
+        with self.assertNumQueries(4):
+            self.assertSequenceEqual(queryset, [monkey, other_monkey])
+            self.assertSequenceEqual(queryset[1].friends.all(), [monkey])
+        queryset = queryset.prefetch_subclass_related(None)
+        with self.assertNumQueries(3):
+            self.assertSequenceEqual(queryset, [monkey, other_monkey])
+            self.assertSequenceEqual(queryset[1].friends.all(), [monkey])
+        with self.assertRaisesMessage(TypeError, "is not a subclass of"):
+            Mammal.objects.prefetch_subclass_related(Snake, "zoos")
+
+    def test_bulk_create(self):
+        objs = [
+            Animal(name="animal"),
+            Monkey(name="monkey"),
+            Snake(name="snake", length=10),
+            Mammal(name="mammal"),
+            BigSnake(name="big snake", length=101),
+            Monkey(name="other monkey"),
+        ]
+        # One query to retrieve the content types and one per table.
+        with self.assertNumQueries(5):
+            self.assertIs(Animal.objects.bulk_create(objs)[0], objs[0])
+        for obj in objs:
+            self.assertIsNotNone(obj.pk)
+            self.assertFalse(obj._state.adding)
+            self.assertEqual(obj._state.db, "default")
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            [
+                "<Animal: animal>",
+                "<Monkey: monkey>",
+                "<Snake: snake>",
+                "<Mammal: mammal>",
+                "<BigSnake: big snake>",
+                "<Monkey: other monkey>",
+            ],
+            transform=repr,
+        )
+        self.assertEqual(Monkey.objects.get(name="monkey"), objs[1])
+        # Instances of single table models are inserted at once.
+        with self.assertNumQueries(1):
+            Animal.objects.bulk_create([Animal(name="animal")])
+        with self.assertRaisesMessage(TypeError, "is not a subclass of"):
+            Mammal.objects.bulk_create([Snake(name="snake", length=10)])
+        with self.assertRaisesMessage(ValueError, "Conflicts handling"):
+            Animal.objects.bulk_create([Mammal(name="mammal")], ignore_conflicts=True)
+
+    def test_bulk_create_multiple_parents(self):
+        objs = [Monkey(name="monkey"), Snake(name="snake", length=10)]
+        get_inheritance_chain = managers.get_inheritance_chain
+
+        def get_multiple_parents_chain(model):
+            if model is Monkey:
+                return None
+            return get_inheritance_chain(model)
+
+        # Objects are saved one by one when a model has multiple parents.
+        with mock.patch(
+            "polymodels.managers.get_inheritance_chain", get_multiple_parents_chain
+        ), mock.patch.object(
+            Monkey, "save", autospec=True, side_effect=Monkey.save
+        ) as save:
+            self.assertIs(Animal.objects.bulk_create(objs)[0], objs[0])
+        save.assert_called_once_with(objs[0], force_insert=True, using="default")
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            ["<Monkey: monkey>", "<Snake: snake>"],
+            transform=repr,
+        )
+
+    def test_bulk_create_child_pk(self):
+        objs = [
+            Monkey(pk=100, name="monkey"),
+            Snake(pk=200, name="snake", length=10),
+            Monkey(name="other monkey"),
+        ]
+        Animal.objects.bulk_create(objs)
+        # Primary keys set on children are used by their parents.
+        self.assertEqual(
+            [(obj.pk, obj.id) for obj in objs[:2]], [(100, 100), (200, 200)]
+        )
+        self.assertEqual(
+            (objs[0].mammal_ptr_id, objs[0].animal_ptr_id, objs[0].id),
+            (100, 100, 100),
+        )
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses().values_list("pk", flat=True),
+            [100, 200, objs[2].pk],
+        )
+        self.assertEqual(Monkey.objects.get(pk=100).name, "monkey")
+
+    def test_bulk_create_cannot_return_rows(self):
+        objs = [Animal(name="animal"), Monkey(name="monkey")]
+        with mock.patch.object(
+            type(connection.features), "can_return_rows_from_bulk_insert", False
+        ):
+            Animal.objects.bulk_create(objs)
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            ["<Animal: animal>", "<Monkey: monkey>"],
+            transform=repr,
+        )
+        self.assertIsNotNone(objs[1].pk)
+
+    def test_bulk_update(self):
+        Animal.objects.create(name="animal")
+        Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        BigSnake.objects.create(name="big snake", length=101)
+        objs = list(Animal.objects.select_subclasses())
+        for obj in objs:
+            obj.name = obj.name.upper()
+            if isinstance(obj, Snake):
+                obj.length *= 2
+        # One query per table owning at least one of the updated fields.
+        with self.assertNumQueries(2):
+            self.assertEqual(Animal.objects.bulk_update(objs, ["name", "length"]), 4)
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            [
+                "<Animal: ANIMAL>",
+                "<Monkey: MONKEY>",
+                "<Snake: SNAKE>",
+                "<BigSnake: BIG SNAKE>",
+            ],
+            transform=repr,
+        )
+        self.assertSequenceEqual(
+            Snake.objects.values_list("length", flat=True), [20, 202]
+        )
+        self.assertEqual(Animal.objects.bulk_update([], ["name"]), 0)
+        # Fields of subclasses are accepted regardless of the instances.
+        self.assertEqual(Animal.objects.bulk_update([], ["length"]), 0)
+        self.assertEqual(Animal.objects.bulk_update(objs[:1], ["length"]), 0)
+        with self.assertRaises(FieldDoesNotExist):
+            Animal.objects.bulk_update(objs, ["name", "inexistent"])
+        with self.assertRaises(FieldDoesNotExist):
+            Animal.objects.bulk_update([], ["inexistent"])
+        with self.assertRaises(FieldDoesNotExist):
+            Mammal.objects.bulk_update([], ["length"])
+        with self.assertRaisesMessage(ValueError, "primary key fields"):
+            Animal.objects.bulk_update(objs, ["mammal_ptr"])
+        with self.assertRaisesMessage(TypeError, "is not a subclass of"):
+            Snake.objects.bulk_update(objs, ["name"])
+
+    def test_change_type(self):
+        animal = Animal.objects.create(name="animal")
+        mammal = Mammal.objects.create(name="mammal")
+        monkey = Monkey.objects.create(name="monkey")
+        other_monkey = Monkey.objects.create(name="other monkey")
+        snake = Snake.objects.create(name="snake", length=10)
+        monkey.friends.add(other_monkey)
+        self.assertEqual(
+            Animal.objects.filter(name__in=["animal", "mammal"]).change_type(Monkey),
+            2,
+        )
+        self.assertEqual(
+            Monkey.objects.filter(name="monkey").change_type(BigSnake, length=42), 1
+        )
+        self.assertEqual(Snake.objects.filter(pk=snake.pk).change_type(Mammal), 1)
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            [
+                "<Monkey: animal>",
+                "<Monkey: mammal>",
+                "<BigSnake: monkey>",
+                "<Monkey: other monkey>",
+                "<Mammal: snake>",
+            ],
+            transform=repr,
+        )
+        self.assertEqual(BigSnake.objects.get().length, 42)
+        self.assertSequenceEqual(Monkey.objects.get(pk=animal.pk).friends.all(), [])
+        self.assertSequenceEqual(other_monkey.friends.all(), [])
+        self.assertEqual(Animal.objects.count(), 5)
+        self.assertEqual(Animal.objects.filter(pk=mammal.pk).change_type(Monkey), 0)
+        with self.assertRaisesMessage(
+            TypeError,
+            "<class 'tests.models.Zoo'> is not a subclass of "
+            "<class 'tests.models.Animal'>",
+        ):
+            Animal.objects.change_type(Zoo)
+        with self.assertRaisesMessage(
+            FieldError,
+            "Cannot provide values for 'lenght', 'name' which are not fields of "
+            "the tables inserted when changing the type to Snake.",
+        ):
+            Animal.objects.change_type(Snake, lenght=4, name="snake")
+        self.assertEqual(BigSnake.objects.get().length, 42)
+        color = Snake._meta.get_field("color")
+        # Field.unique might be cached.
+        color.__dict__.pop("unique", None)
+        self.addCleanup(color.__dict__.pop, "unique", None)
+        with mock.patch.object(color, "_unique", True), mock.patch.object(
+            color, "default", lambda: "red"
+        ), self.assertRaisesMessage(
+            ValueError,
+            "A value must be provided for Snake.color as its callable default "
+            "cannot be evaluated for each inserted row.",
+        ):
+            Animal.objects.filter(pk=mammal.pk).change_type(Snake, length=4)
+        self.assertEqual(
+            Animal.objects.filter(pk=mammal.pk).change_type(
+                Snake, length=4, color="red"
+            ),
+            1,
+        )
+
+    def test_delete(self):
+        Animal.objects.create(name="animal")
+        Mammal.objects.create(name="mammal")
+        monkey = Monkey.objects.create(name="monkey")
+        Snake.objects.create(name="snake", length=10)
+        monkey.friends.add(Monkey.objects.create(name="other monkey"))
+        # Retrieving the animals, their toys, deleting their zoos and deleting
+        # them. The subclasses tables are not queried.
+        with self.assertNumQueries(4):
+            Animal.objects.filter(name="animal").delete()
+        # The tables of the deleted subclasses are queried.
+        deleted, deleted_per_model = (
+            Animal.objects.select_subclasses().exclude(name="snake").delete()
+        )
+        self.assertEqual(
+            deleted_per_model,
+            {
+                "tests.Monkey_friends": 2,
+                "tests.Monkey": 2,
+                "tests.Mammal": 3,
+                "tests.Animal": 3,
+            },
+        )
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(), ["<Snake: snake>"], transform=repr
+        )
+
+    def test_delete_nested_subclasses(self):
+        Mammal.objects.create(name="mammal")
+        Mammal.objects.create(name="other mammal")
+        Monkey.objects.create(name="monkey")
+        # The content types of the deleted mammals are known from the collected
+        # animals so the monkeys table is not queried.
+        with CaptureQueriesContext(connection) as ctx:
+            deleted, _ = Animal.objects.filter(name__endswith="mammal").delete()
+        self.assertEqual(deleted, 4)
+        for query in ctx.captured_queries:
+            self.assertNotIn(Monkey._meta.db_table, query["sql"])
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(), ["<Monkey: monkey>"], transform=repr
+        )
+
+    def test_delete_keep_parents(self):
+        Animal.objects.create(name="animal")
+        mammal = Mammal.objects.create(name="mammal")
+        monkey = Monkey.objects.create(name="monkey")
+        other_monkey = Monkey.objects.create(name="other monkey")
+        snake = HugeSnake.objects.create(name="snake", length=10)
+        monkey.friends.add(other_monkey)
+        deleted, deleted_per_model = Mammal.objects.exclude(pk=mammal.pk).delete(
+            keep_parents=True
+        )
+        self.assertEqual(deleted_per_model["tests.Mammal"], 2)
+        self.assertEqual(deleted_per_model["tests.Monkey"], 2)
+        self.assertNotIn("tests.Animal", deleted_per_model)
+        self.assertQuerySetEqual(
+            Animal.objects.select_subclasses(),
+            [
+                "<Animal: animal>",
+                "<Mammal: mammal>",
+                "<Animal: monkey>",
+                "<Animal: other monkey>",
+                "<HugeSnake: snake>",
+            ],
+            transform=repr,
+        )
+        Snake.objects.select_subclasses().delete(keep_parents=True)
+        self.assertEqual(type(Animal.objects.get(pk=snake.pk).type_cast()), Animal)
+        # Models without parents are simply deleted.
+        Animal.objects.filter(name="animal").delete(keep_parents=True)
+        self.assertEqual(Animal.objects.count(), 4)
+
+    def test_select_subclasses_iterator_prefetch_related(self):
+        zoo = Zoo.objects.create()
+        animal = Animal.objects.create(name="animal")
+        monkey = Monkey.objects.create(name="monkey")
+        other_monkey = Monkey.objects.create(name="other monkey")
+        snake = BigSnake.objects.create(name="snake", length=10)
+        zoo.animals.add(animal, monkey)
+        monkey.friends.add(other_monkey)
+        queryset = (
+            Animal.objects.select_subclasses()
+            .prefetch_related("zoos")
+            .prefetch_subclass_related(Monkey, "friends")
+        )
+        # One query for the base rows and one for the zoos and the friends of
+        # each chunk.
+        with self.assertNumQueries(5):
+            animals = list(queryset.iterator(chunk_size=2))
+            self.assertEqual(animals, [animal, monkey, other_monkey, snake])
+            self.assertEqual(
+                list(map(type, animals)), [Animal, Monkey, Monkey, BigSnake]
+            )
+            self.assertSequenceEqual(animals[0].zoos.all(), [zoo])
+            self.assertSequenceEqual(animals[1].zoos.all(), [zoo])
+            self.assertSequenceEqual(animals[1].friends.all(), [other_monkey])
+            self.assertSequenceEqual(animals[2].friends.all(), [monkey])
+        # Subclass lookups alone don't require a chunk size.
+        queryset = queryset.prefetch_related(None)
+        with self.assertNumQueries(2):
+            animals = list(queryset.iterator())
+            self.assertSequenceEqual(animals[2].friends.all(), [monkey])
+
+    async def test_select_subclasses_aiterator(self):
+        zoo = await Zoo.objects.acreate()
+        animal = await Animal.objects.acreate(name="animal")
+        monkey = await Monkey.objects.acreate(name="monkey")
+        other_monkey = await Monkey.objects.acreate(name="other monkey")
+        snake = BigSnake(name="snake", length=10)
+        await snake.asave()
+        await zoo.animals.aadd(animal, monkey)
+        await monkey.friends.aadd(other_monkey)
+        queryset = (
+            Animal.objects.select_subclasses()
+            .prefetch_related("zoos")
+            .prefetch_subclass_related(Monkey, "friends")
+        )
+        for strategy in ("join", "per_type"):
+            with self.subTest(strategy=strategy):
+                animals = [
+                    obj
+                    async for obj in queryset.select_subclasses(
+                        strategy=strategy
+                    ).aiterator(chunk_size=2)
+                ]
+                self.assertEqual(animals, [animal, monkey, other_monkey, snake])
+                self.assertEqual(
+                    list(map(type, animals)), [Animal, Monkey, Monkey, BigSnake]
+                )
+                # Accessing non-prefetched relationships would crash in an
+                # asynchronous context.
+                self.assertEqual(list(animals[0].zoos.all()), [zoo])
+                self.assertEqual(list(animals[1].zoos.all()), [zoo])
+                self.assertEqual(list(animals[1].friends.all()), [other_monkey])
+                self.assertEqual(list(animals[2].friends.all()), [monkey])
+        self.assertEqual(
+            [obj async for obj in Animal.objects.select_subclasses()],
+            [animal, monkey, other_monkey, snake],
+        )
+        self.assertEqual(
+            [obj async for obj in Animal.objects.values_list("name", flat=True)],
+            ["animal", "monkey", "other monkey", "snake"],
+        )
+
+    async def test_atype_cast_many(self):
+        zoo = await Zoo.objects.acreate()
+        animal = await Animal.objects.acreate(name="animal")
+        monkey = await Monkey.objects.acreate(name="monkey")
+        snake = BigSnake(name="snake", length=10)
+        await snake.asave()
+        await zoo.animals.aadd(animal, monkey)
+        objs = [obj async for obj in Animal.objects.prefetch_related("zoos")]
+        casted = await polymodels.atype_cast_many(objs, with_prefetched_objects=True)
+        self.assertEqual(casted, [animal, monkey, snake])
+        self.assertEqual(list(map(type, casted)), [Animal, Monkey, BigSnake])
+        # Accessing non-prefetched relationships would crash in an
+        # asynchronous context.
+        self.assertEqual(list(casted[1].zoos.all()), [zoo])
+        self.assertEqual(list(casted[2].zoos.all()), [])
+        casted = await Animal.objects.atype_cast_many(Animal.objects.all())
+        self.assertEqual(list(map(type, casted)), [Animal, Monkey, BigSnake])
+
 
 class PolymorphicManagerTest(TestCase):
     def test_improperly_configured(self):
@@ -1,7 +1,12 @@
+import threading
+from unittest import mock
+
+from django.apps import apps
 from django.apps.registry import Apps
 from django.contrib.contenttypes.models import ContentType
 from django.core import checks
 from django.db import models
+from django.db.models.signals import post_init
 from django.test.testcases import SimpleTestCase
 
 from polymodels.models import (
@@ -12,7 +17,7 @@ from polymodels.models import (
 )
 
 from .base import TestCase
-from .models import Animal, BigSnake, HugeSnake, Mammal, Snake
+from .models import Animal, BigSnake, HugeSnake, Mammal, Monkey, Snake
 
 
 class BasePolymorphicModelTest(TestCase):
@@ -132,6 +137,104 @@ class BasePolymorphicModelTest(TestCase):
             self.assertIsInstance(anaconda_animal_type_casted, subclass)
             self.assertEqual(anaconda_animal_type_casted.color, "green")
 
+    def test_type_cast_proxy(self):
+        BigSnake.objects.create(name="anaconda", length=152, color="green")
+        snake = (
+            Snake.objects.select_related("content_type")
+            .annotate(double_length=models.F("length") * 2)
+            .defer("color")
+            .get()
+        )
+        inits = []
+
+        def receiver(sender, instance, **kwargs):
+            inits.append(instance)
+
+        post_init.connect(receiver)
+        self.addCleanup(post_init.disconnect, receiver)
+        with self.assertNumQueries(0):
+            big_snake = snake.type_cast()
+        self.assertIsInstance(big_snake, BigSnake)
+        self.assertEqual(inits, [])
+        self.assertEqual(big_snake.pk, snake.pk)
+        self.assertEqual(big_snake.double_length, 304)
+        self.assertEqual(big_snake._state.db, "default")
+        self.assertFalse(big_snake._state.adding)
+        self.assertEqual(big_snake.get_deferred_fields(), {"color"})
+        self.assertIsNot(big_snake._state, snake._state)
+        self.assertIsNot(big_snake._state.fields_cache, snake._state.fields_cache)
+        with self.assertNumQueries(0):
+            self.assertEqual(big_snake.content_type, snake.content_type)
+
+    async def test_atype_cast(self):
+        mammal = await Mammal.objects.acreate(name="cat")
+        snake = BigSnake(name="anaconda", length=152)
+        await snake.asave()
+        animal = await Animal.objects.aget(pk=mammal.pk)
+        self.assertEqual(await animal.atype_cast(), mammal)
+        self.assertIsInstance(await animal.atype_cast(Mammal), Mammal)
+        animal = await Animal.objects.select_related("snake").aget(pk=snake.pk)
+        self.assertIsInstance(await animal.atype_cast(), BigSnake)
+        with self.assertRaises(Mammal.DoesNotExist):
+            await animal.atype_cast(Mammal)
+
+    def test_type_cast_dispatch(self):
+        mammal = Mammal.objects.create(name="cat")
+        animal = Animal.objects.get(pk=mammal.pk)
+        dispatch = Animal.subclass_accessors.get_dispatch()
+        self.assertIs(Animal.subclass_accessors.get_dispatch(), dispatch)
+        with self.assertNumQueries(1):
+            self.assertEqual(animal.type_cast(), mammal)
+        self.assertEqual(
+            dispatch,
+            {mammal.content_type_id: Animal.subclass_accessors[Mammal]},
+        )
+        # Clearing the content types cache discards the dispatch table.
+        ContentType.objects.clear_cache()
+        self.assertIsNot(Animal.subclass_accessors.get_dispatch(), dispatch)
+        dispatch = Animal.subclass_accessors.get_dispatch()
+        self.assertIs(Animal.subclass_accessors.get_dispatch(), dispatch)
+        # So does clearing the apps registry cache.
+        apps.clear_cache()
+        self.assertIsNot(Animal.subclass_accessors.get_dispatch(), dispatch)
+
+    def test_subclasses_lookup(self):
+        content_types = ContentType.objects.get_for_models(
+            Snake, BigSnake, HugeSnake, for_concrete_models=False
+        )
+        lookup = Snake.subclasses_lookup()
+        self.assertEqual(
+            lookup, {"content_type__in": {ct.pk for ct in content_types.values()}}
+        )
+        self.assertIsInstance(lookup["content_type__in"], frozenset)
+        self.assertEqual(
+            BigSnake.subclasses_lookup("pk"),
+            {
+                "pk__in": {
+                    content_types[BigSnake].pk,
+                    content_types[HugeSnake].pk,
+                }
+            },
+        )
+        # The content type pks are cached until the content types cache is
+        # cleared.
+        with mock.patch("polymodels.models.get_content_types") as get_content_types:
+            with self.assertNumQueries(0):
+                self.assertIs(
+                    Snake.subclasses_lookup()["content_type__in"],
+                    lookup["content_type__in"],
+                )
+                BigSnake.objects.all()
+        get_content_types.assert_not_called()
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(1):
+            self.assertEqual(Snake.subclasses_lookup(), lookup)
+        # Content type pks are cached per database.
+        self.assertIs(
+            Snake.subclasses_lookup(using="default")["content_type__in"],
+            Snake.subclass_accessors.content_type_ids["default"][1],
+        )
+
     def test_content_type_saving(self):
         # Creating a base class should assign the correct content_type.
         animal_content_type = ContentType.objects.get_for_model(Animal)
@@ -171,6 +274,84 @@ class BasePolymorphicModelTest(TestCase):
 
 
 class SubclassAccessorsTests(SimpleTestCase):
+    def test_inheritance_index(self):
+        subclass_accessors = BasePolymorphicModel.subclass_accessors
+        subclass_accessors.clear()
+        self.addCleanup(subclass_accessors.clear)
+        with mock.patch.object(apps, "get_models", wraps=apps.get_models) as get_models:
+            self.assertEqual(
+                Animal.subclass_accessors[Monkey].attrs, ("mammal", "monkey")
+            )
+            self.assertEqual(Mammal.subclass_accessors[Monkey].attrs, ("monkey",))
+            self.assertEqual(Snake.subclass_accessors[HugeSnake].proxy, HugeSnake)
+            self.assertEqual(BigSnake.subclass_accessors[BigSnake], EMPTY_ACCESSOR)
+        # The installed models are only scanned once.
+        get_models.assert_called_once_with()
+        index = subclass_accessors.get_index()
+        self.assertIs(subclass_accessors.get_index(), index)
+        self.assertCountEqual(index.children[Animal], [Mammal, Snake])
+        self.assertCountEqual(index.children[Snake], [BigSnake, HugeSnake])
+        self.assertEqual(index.children[BigSnake], (HugeSnake,))
+        # The index is discarded when a subclass is created.
+        test_apps = Apps(["tests"])
+
+        class DynamicSnake(Snake):
+            class Meta:
+                apps = test_apps
+                proxy = True
+
+        self.assertIsNot(subclass_accessors.get_index(), index)
+
+    def test_concurrent_access(self):
+        subclass_accessors = BasePolymorphicModel.subclass_accessors
+        subclass_accessors.clear()
+        self.addCleanup(subclass_accessors.clear)
+        models = [Animal, Mammal, Monkey, Snake, BigSnake, HugeSnake]
+        threads_count = 16
+        barrier = threading.Barrier(threads_count)
+        results = []
+
+        def access():
+            barrier.wait()
+            results.append(
+                [(model, model.subclass_accessors) for model in models * 100]
+            )
+
+        def run_threads():
+            threads = [threading.Thread(target=access) for _ in range(threads_count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        with mock.patch.object(apps, "get_models", wraps=apps.get_models) as get_models:
+            run_threads()
+        # The index is built only once and all threads see the same complete
+        # accessors.
+        get_models.assert_called_once_with()
+        self.assertEqual(len(results), threads_count)
+        for result in results:
+            for model, accessors in result:
+                self.assertIs(accessors, model.subclass_accessors)
+                self.assertIs(accessors.model, model)
+                self.assertEqual(
+                    len(accessors),
+                    {
+                        Animal: 6,
+                        Mammal: 2,
+                        Monkey: 1,
+                        Snake: 3,
+                        BigSnake: 2,
+                        HugeSnake: 1,
+                    }[model],
+                )
+        # Reads of built accessors never acquire the lock.
+        results.clear()
+        with mock.patch.object(subclass_accessors, "lock") as lock:
+            run_threads()
+        lock.__enter__.assert_not_called()
+        self.assertEqual(len(results), threads_count)
+
     def test_dynamic_model_creation_cache_busting(self):
         test_apps = Apps(["tests"])
 
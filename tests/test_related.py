@@ -1,5 +1,9 @@
+from django.db.models.functions import Upper
+
+from polymodels.managers import PolymorphicPrefetch
+
 from .base import TestCase
-from .models import Mammal, Monkey, Zoo
+from .models import Animal, Ball, BigSnake, Mammal, Monkey, Snake, Toy, Zoo
 
 
 class RelatedManagerTest(TestCase):
@@ -15,3 +19,142 @@ class RelatedManagerTest(TestCase):
         zoo_animals = zoo.animals.select_subclasses()
         self.assertIn(yeti, zoo_animals)
         self.assertNotIn(pepe, zoo_animals)
+
+
+class PolymorphicPrefetchTest(TestCase):
+    def setUp(self):
+        self.zoo = Zoo.objects.create()
+        self.zoo.animals.set(
+            [
+                Animal.objects.create(name="animal"),
+                Monkey.objects.create(name="monkey"),
+                Snake.objects.create(name="snake", length=10),
+                BigSnake.objects.create(name="big snake", length=101),
+            ]
+        )
+        Zoo.objects.create()
+        self.expected = [
+            "<Animal: animal>",
+            "<Monkey: monkey>",
+            "<Snake: snake>",
+            "<BigSnake: big snake>",
+        ]
+
+    def test_prefetch(self):
+        queryset = Zoo.objects.order_by("pk").prefetch_related(
+            PolymorphicPrefetch("animals", subclasses=[Animal])
+        )
+        # A single query is issued per content type.
+        with self.assertNumQueries(5):
+            zoos = list(queryset)
+        with self.assertNumQueries(0):
+            self.assertQuerySetEqual(
+                zoos[0].animals.all(), self.expected, transform=repr
+            )
+            self.assertQuerySetEqual(zoos[1].animals.all(), [])
+
+    def test_prefetch_shared(self):
+        monkey = Monkey.objects.get()
+        other_zoo = Zoo.objects.exclude(pk=self.zoo.pk).get()
+        other_zoo.animals.add(monkey)
+        for strategy in ("join", "per_type", "union"):
+            with self.subTest(strategy=strategy):
+                zoos = Zoo.objects.order_by("pk").prefetch_related(
+                    PolymorphicPrefetch(
+                        "animals", subclasses=[Animal], strategy=strategy
+                    )
+                )
+                self.assertQuerySetEqual(
+                    zoos[0].animals.all(), self.expected, transform=repr
+                )
+                self.assertQuerySetEqual(
+                    zoos[1].animals.all(), ["<Monkey: monkey>"], transform=repr
+                )
+
+    def test_prefetch_join(self):
+        queryset = Animal.objects.annotate(upper=Upper("name"))
+        with self.assertNumQueries(2):
+            zoos = list(
+                Zoo.objects.prefetch_related(
+                    PolymorphicPrefetch(
+                        "animals",
+                        queryset=queryset,
+                        to_attr="animal_list",
+                        strategy="join",
+                    )
+                )
+            )
+        self.assertQuerySetEqual(zoos[0].animal_list, self.expected, transform=repr)
+        # Annotations are preserved on type casted instances.
+        self.assertEqual(
+            [animal.upper for animal in zoos[0].animal_list],
+            ["ANIMAL", "MONKEY", "SNAKE", "BIG SNAKE"],
+        )
+
+    def test_prefetch_subclasses(self):
+        queryset = Zoo.objects.prefetch_related(
+            PolymorphicPrefetch("animals", subclasses=[Mammal, Snake])
+        )
+        with self.assertNumQueries(5):
+            zoo = queryset.get(pk=self.zoo.pk)
+        with self.assertNumQueries(0):
+            self.assertQuerySetEqual(
+                zoo.animals.all(), self.expected[1:], transform=repr
+            )
+
+    def test_prefetch_nested(self):
+        with self.assertNumQueries(3):
+            monkey = Monkey.objects.prefetch_related(
+                PolymorphicPrefetch(
+                    "zoos__animals", queryset=Animal.objects.all(), strategy="join"
+                )
+            ).get()
+        with self.assertNumQueries(0):
+            self.assertQuerySetEqual(
+                monkey.zoos.all()[0].animals.all(), self.expected, transform=repr
+            )
+
+    def test_prefetch_reverse_foreign_key(self):
+        monkey = Monkey.objects.get()
+        snake = Snake.objects.get(name="snake")
+        Toy.objects.create(owner=monkey)
+        Ball.objects.create(owner=monkey)
+        Ball.objects.create(owner=snake)
+        for strategy, num_queries in [("per_type", 3), ("join", 2)]:
+            with self.subTest(strategy=strategy):
+                queryset = Animal.objects.prefetch_related(
+                    PolymorphicPrefetch("toys", subclasses=[Toy], strategy=strategy)
+                )
+                with self.assertNumQueries(num_queries):
+                    animals = list(queryset)
+                with self.assertNumQueries(0):
+                    self.assertEqual(
+                        [list(map(type, animal.toys.all())) for animal in animals],
+                        [[], [Toy, Ball], [Ball], []],
+                    )
+                    # The reverse relationship is cached on casted instances.
+                    self.assertIs(animals[1].toys.all()[1].owner, animals[1])
+
+    def test_prefetch_nested_reverse_foreign_key(self):
+        Ball.objects.create(owner=Monkey.objects.get())
+        queryset = Zoo.objects.prefetch_related(
+            PolymorphicPrefetch("animals__toys", subclasses=[Toy])
+        )
+        with self.assertNumQueries(4):
+            zoo = queryset.get(pk=self.zoo.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [list(map(type, animal.toys.all())) for animal in zoo.animals.all()],
+                [[], [Ball], [], []],
+            )
+
+    def test_invalid(self):
+        with self.assertRaisesMessage(
+            ValueError, "A queryset or subclasses must be provided"
+        ):
+            PolymorphicPrefetch("animals")
+        with self.assertRaisesMessage(
+            ValueError,
+            "PolymorphicPrefetch querysets must be PolymorphicQuerySet instances.",
+        ):
+            PolymorphicPrefetch("zoos", queryset=Zoo.objects.all())